@@ -51,6 +51,24 @@ variable "ssh_private_key_file_path" {
   description = "Path to the private key for the gha_runner_image_builder keypair"
 }
 
+variable "runner_version" {
+  type = string
+  default = "2.317.0"
+  description = "The version of the Github Actions runner to unpack into the image"
+}
+
+variable "runner_sha256" {
+  type = string
+  default = "9e883d210df8c6028aff475475a457d380353f9d01877d51cc01a17b2a91161d"
+  description = "The SHA-256 checksum of the runner's linux-x64 release archive"
+}
+
+variable "sccache_version" {
+  type = string
+  default = "0.8.1"
+  description = "The version of sccache to install, for the runners' shared compilation cache"
+}
+
 variable "ssh_keypair_name" {
   type = string
   default = "gha_runner_image_builder"
@@ -68,6 +86,10 @@ source "amazon-ebs" "ubuntu" {
   ssh_private_key_file = var.ssh_private_key_file_path
   ssh_keypair_name     = var.ssh_keypair_name
 
+  tags = {
+    RunnerVersion = var.runner_version
+  }
+
   ami_block_device_mappings {
     device_name = "/dev/sdb"
     delete_on_termination = true
@@ -83,5 +105,10 @@ build {
   ]
   provisioner "shell" {
     script = "./scripts/init-runner.sh"
+    environment_vars = [
+      "RUNNER_VERSION=${var.runner_version}",
+      "RUNNER_SHA256=${var.runner_sha256}",
+      "SCCACHE_VERSION=${var.sccache_version}"
+    ]
   }
 }
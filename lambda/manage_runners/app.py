@@ -1,215 +1,3625 @@
 import base64
-import boto3
+import functools
 import hmac
 import hashlib
 import json
-import jwt
 import logging
 import os
-import requests
+import random
+import sys
+import threading
 import time
+import uuid
+
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime
+
+# The boto3, jwt (which loads cryptography) and requests packages are only imported in the functions
+# that use them. Between them they account for most of the time it takes to load this module, and
+# many events, such as those with an `in_progress` action, don't need any of them. That time is
+# added to every cold start.
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 
-# The EC2 infrastructure executes the user data script as the root user and you
-# don't have any control over that. However, the runner configuration doesn't
-# allow execution as root, but you *do* need to install and start the service as
-# root. Hence, a bunch of commands execute as the ubuntu user, then we switch
-# back to root. The directory switches to the home directory are necessary.
-# The registration token will be supplied before the script is passed to the
-# RunInstances API.
-USER_DATA_SCRIPT = """#!/bin/bash
-
-output=$(file -b -s /dev/nvme1n1)
-until [ "$output" == "data" ]
-do
-    echo "$output"
-    echo "disk still not mounted..."
-    output=$(file -b -s /dev/nvme1n1)
-done
-mkfs -t ext4 /dev/nvme1n1
-mkdir /mnt/data
-mount /dev/nvme1n1 /mnt/data
+# Reports the boot of the instance as a span in the trace of the job it was launched for, so the time
+# between the job being queued and its runner coming online can be broken down. The trace context is
+# supplied in the W3C `traceparent` format, and each step of the boot is recorded as an event on the
+# span. The span is exported over OTLP/HTTP once the runner has started, or when the script exits,
+# if that's sooner. Without a trace context or an endpoint, nothing is reported.
+BOOT_TRACING_SCRIPT = r"""
+TRACEPARENT="__TRACEPARENT__"
+OTLP_ENDPOINT="__OTLP_ENDPOINT__"
+BOOT_STARTED_AT=$(date +%s%N)
+BOOT_SPAN_ID=$(od -An -N8 -tx1 /dev/urandom | tr -d ' \n')
+BOOT_EVENTS=""
+span_event() {
+    BOOT_EVENTS="${BOOT_EVENTS:+${BOOT_EVENTS},}{\"timeUnixNano\":\"$(date +%s%N)\",\"name\":\"$1\"}"
+}
+export_boot_span() {
+    local status=$? status_code=1 trace_id parent_span_id imds_token instance_id
+    if [ -n "$BOOT_SPAN_EXPORTED" ] || [ -z "$TRACEPARENT" ] || [ -z "$OTLP_ENDPOINT" ]; then
+        return 0
+    fi
+    BOOT_SPAN_EXPORTED=1
+    [ "$status" -eq 0 ] || status_code=2
+    trace_id=$(echo "$TRACEPARENT" | cut -d- -f2)
+    parent_span_id=$(echo "$TRACEPARENT" | cut -d- -f3)
+    imds_token=$(curl -s -m 2 -X PUT "http://169.254.169.254/latest/api/token" \
+      -H "X-aws-ec2-metadata-token-ttl-seconds: 60")
+    instance_id=$(curl -s -m 2 -H "X-aws-ec2-metadata-token: ${imds_token}" \
+      http://169.254.169.254/latest/meta-data/instance-id)
+    curl -s -m 5 -X POST "${OTLP_ENDPOINT}/v1/traces" -H "Content-Type: application/json" \
+      -d @- <<JSON || true
+{"resourceSpans":[{"resource":{"attributes":[
+{"key":"service.name","value":{"stringValue":"gha-runner"}},
+{"key":"host.id","value":{"stringValue":"${instance_id}"}}]},
+"scopeSpans":[{"scope":{"name":"user-data"},"spans":[{
+"traceId":"${trace_id}","spanId":"${BOOT_SPAN_ID}","parentSpanId":"${parent_span_id}",
+"name":"instance.boot","kind":1,
+"startTimeUnixNano":"${BOOT_STARTED_AT}","endTimeUnixNano":"$(date +%s%N)",
+"events":[${BOOT_EVENTS}],"status":{"code":${status_code}}}]}]}]}
+JSON
+}
+trap export_boot_span EXIT
+"""
+# Prepares the data volume, where the runner's work directory and the Cargo home are kept.
+#
+# The EBS data volume may not have been attached by the time the script runs, so it waits for udev
+# to process the device events, up to a timeout, rather than polling the device. Any instance store
+# disks are used as well, unless `USE_INSTANCE_STORE` is `false`, and several disks are combined
+# into a RAID0 array. The root disk is never used. A disk that already has a filesystem is mounted as
+# it is. Otherwise it's formatted with lazy inode table and journal initialisation, which the kernel
+# completes in the background, so formatting takes seconds rather than minutes.
+DATA_DISK_SCRIPT = r"""
+DATA_DISK_TIMEOUT_SECONDS=120
+ROOT_DISK=$(lsblk -no PKNAME "$(findmnt -n -o SOURCE /)")
+list_disks() {
+    lsblk -dn -o NAME,MODEL | while read -r name model; do
+        if [ "$name" != "$ROOT_DISK" ] && [ "$model" == "$1" ]; then
+            echo "/dev/${name}"
+        fi
+    done
+}
+data_disk_deadline=$(( $(date +%s) + DATA_DISK_TIMEOUT_SECONDS ))
+udevadm settle --timeout="${DATA_DISK_TIMEOUT_SECONDS}"
+until [ -n "$(list_disks "Amazon Elastic Block Store")" ]; do
+    if [ "$(date +%s)" -ge "$data_disk_deadline" ]; then
+        echo "The data volume wasn't attached within ${DATA_DISK_TIMEOUT_SECONDS} seconds"
+        exit 1
+    fi
+    udevadm settle --timeout=5
+    sleep 1
+done
+DATA_DISKS=($(list_disks "Amazon Elastic Block Store"))
+if [ "${USE_INSTANCE_STORE:-true}" == "true" ]; then
+    DATA_DISKS+=($(list_disks "Amazon EC2 NVMe Instance Storage"))
+fi
+if [ "${#DATA_DISKS[@]}" -gt 1 ]; then
+    echo "Combining ${DATA_DISKS[*]} into a RAID0 array..."
+    mdadm --create /dev/md0 --run --level=0 --raid-devices="${#DATA_DISKS[@]}" "${DATA_DISKS[@]}"
+    udevadm settle --timeout="${DATA_DISK_TIMEOUT_SECONDS}"
+    DATA_DEVICE=/dev/md0
+else
+    DATA_DEVICE="${DATA_DISKS[0]}"
+fi
+span_event disk_ready
+if blkid -s TYPE -o value "$DATA_DEVICE" | grep -q .; then
+    echo "Using the existing filesystem on ${DATA_DEVICE}"
+else
+    mkfs -t ext4 -q -m 0 -E lazy_itable_init=1,lazy_journal_init=1,nodiscard "$DATA_DEVICE"
+fi
+span_event mkfs_done
+mkdir -p /mnt/data
+mount -o noatime "$DATA_DEVICE" /mnt/data
+
+mkdir -p /mnt/data/tmp
+chmod 0777 /mnt/data/tmp
+
+mkdir -p /mnt/data/runner
+chown ubuntu:ubuntu /mnt/data/runner
+
+mkdir -p /mnt/data/cargo
+chown ubuntu:ubuntu /mnt/data/cargo
+echo "CARGO_HOME=/mnt/data/cargo" >> /etc/environment
+"""
+# The runner is unpacked into the image when it's built, with its version recorded alongside it, so
+# normally there's nothing to download. If the image has a different version, because it hasn't
+# been rebuilt since the version was changed, the release is downloaded instead. It's only unpacked
+# if it matches the checksum. Either way, the work directory is kept on the data volume.
+RUNNER_SETUP_SCRIPT = """
+RUNNER_VERSION="__RUNNER_VERSION__"
+RUNNER_SHA256="__RUNNER_SHA256__"
+if [ "$(cat /opt/actions-runner/.runner-version 2>/dev/null)" != "${RUNNER_VERSION}" ]; then
+    echo "The image doesn't have runner ${RUNNER_VERSION}; downloading it..."
+    RUNNER_ARCHIVE_NAME="actions-runner-linux-x64-${RUNNER_VERSION}.tar.gz"
+    RUNNER_ARCHIVE_PATH="/mnt/data/tmp/${RUNNER_ARCHIVE_NAME}"
+    curl -s -f -L -o "${RUNNER_ARCHIVE_PATH}" \
+      "https://github.com/actions/runner/releases/download/v${RUNNER_VERSION}/${RUNNER_ARCHIVE_NAME}"
+    if ! echo "${RUNNER_SHA256}  ${RUNNER_ARCHIVE_PATH}" | sha256sum -c --status; then
+        echo "The checksum of ${RUNNER_ARCHIVE_NAME} doesn't match ${RUNNER_SHA256}"
+        exit 1
+    fi
+    rm -rf /opt/actions-runner
+    mkdir /opt/actions-runner
+    tar xzf "${RUNNER_ARCHIVE_PATH}" -C /opt/actions-runner
+    rm "${RUNNER_ARCHIVE_PATH}"
+    echo "${RUNNER_VERSION}" > /opt/actions-runner/.runner-version
+    chown -R ubuntu:ubuntu /opt/actions-runner
+    span_event runner_downloaded
+fi
+mkdir -p /mnt/data/runner/_work
+chown ubuntu:ubuntu /mnt/data/runner/_work
+ln -sfn /mnt/data/runner/_work /opt/actions-runner/_work
+span_event runner_ready
+"""
+# The runner hooks that measure how well the shared compilation cache is working. The statistics of
+# the sccache server are zeroed before each job, and afterwards its hits and misses are put to
+# CloudWatch, with the toolchain as a dimension, so the hit rate can be charted for each toolchain.
+# A failure is ignored, because the runner fails the job if a hook does.
+SCCACHE_JOB_STARTED_HOOK = r"""#!/bin/bash
+sccache --zero-stats > /dev/null 2>&1 || true
+"""
+SCCACHE_JOB_COMPLETED_HOOK = r"""#!/bin/bash
+stats=$(sccache --show-stats --stats-format json 2> /dev/null) || exit 0
+hits=$(echo "$stats" | jq '[.stats.cache_hits.counts[]?] | add // 0')
+misses=$(echo "$stats" | jq '[.stats.cache_misses.counts[]?] | add // 0')
+if [ $(( hits + misses )) -eq 0 ]; then
+    exit 0
+fi
+hit_rate=$(awk -v hits="$hits" -v misses="$misses" \
+  'BEGIN { printf "%.1f", 100 * hits / (hits + misses) }')
+dimensions="Dimensions=[{Name=Toolchain,Value=${SCCACHE_S3_KEY_PREFIX##*/}}]"
+aws cloudwatch put-metric-data --region "$SCCACHE_REGION" --namespace "__METRICS_NAMESPACE__" \
+  --metric-data "MetricName=SccacheHits,Value=${hits},Unit=Count,${dimensions}" \
+  "MetricName=SccacheMisses,Value=${misses},Unit=Count,${dimensions}" \
+  "MetricName=SccacheHitRate,Value=${hit_rate},Unit=Percent,${dimensions}" || true
+exit 0
+"""
+# Points Cargo at sccache, backed by the shared S3 bucket, so a runner reuses the crates that any
+# other runner has compiled. The cache is keyed by the Rust toolchain in the image, so images with
+# different toolchains don't share, or evict, each other's objects. Incremental compilation can't be
+# cached, so it's turned off. The variables go in the runner's `.env` file, which it loads into the
+# environment of every job, as well as `/etc/environment`. Without a bucket, nothing is set up.
+SCCACHE_SCRIPT = (
+    r"""
+SCCACHE_BUCKET="__SCCACHE_BUCKET__"
+SCCACHE_REGION="__SCCACHE_REGION__"
+SCCACHE_ENDPOINT="__SCCACHE_ENDPOINT__"
+SCCACHE_KEY_PREFIX="__SCCACHE_KEY_PREFIX__"
+if [ -n "$SCCACHE_BUCKET" ] && [ -x /usr/local/bin/sccache ]; then
+    RUST_TOOLCHAIN=$(su ubuntu -c "rustc -vV" | awk '
+      /^release:/ { release = $2 }
+      /^commit-hash:/ { commit = substr($2, 1, 9) }
+      /^host:/ { host = $2 }
+      END { print release "-" commit "-" host }')
+    mkdir -p /opt/sccache
+    cat > /opt/sccache/job-started.sh <<'HOOK'
+"""
+    + SCCACHE_JOB_STARTED_HOOK
+    + """HOOK
+    cat > /opt/sccache/job-completed.sh <<'HOOK'
+"""
+    + SCCACHE_JOB_COMPLETED_HOOK
+    + r"""HOOK
+    chmod 0755 /opt/sccache/job-started.sh /opt/sccache/job-completed.sh
+    {
+        echo "RUSTC_WRAPPER=/usr/local/bin/sccache"
+        echo "CARGO_INCREMENTAL=0"
+        echo "SCCACHE_BUCKET=${SCCACHE_BUCKET}"
+        echo "SCCACHE_REGION=${SCCACHE_REGION}"
+        echo "SCCACHE_S3_KEY_PREFIX=${SCCACHE_KEY_PREFIX}/${RUST_TOOLCHAIN}"
+        echo "SCCACHE_IDLE_TIMEOUT=0"
+        if [ -n "$SCCACHE_ENDPOINT" ]; then
+            echo "SCCACHE_ENDPOINT=${SCCACHE_ENDPOINT}"
+        fi
+        if [[ "$SCCACHE_ENDPOINT" == http://* ]]; then
+            echo "SCCACHE_S3_USE_SSL=false"
+        fi
+        echo "ACTIONS_RUNNER_HOOK_JOB_STARTED=/opt/sccache/job-started.sh"
+        echo "ACTIONS_RUNNER_HOOK_JOB_COMPLETED=/opt/sccache/job-completed.sh"
+    } | tee -a /etc/environment >> /opt/actions-runner/.env
+    chown ubuntu:ubuntu /opt/actions-runner/.env
+    span_event sccache_configured
+fi
+"""
+)
+# The EC2 infrastructure executes the user data script as the root user and you
+# don't have any control over that. However, the runner configuration doesn't
+# allow execution as root, but you *do* need to install and start the service as
+# root. Hence, a bunch of commands execute as the ubuntu user, then we switch
+# back to root. The directory switches to the home directory are necessary.
+# The registration token will be supplied before the script is passed to the
+# RunInstances API. The runner is named after the instance, so the instance that ran a job can be
+# found from the runner name in the `completed` event.
+RUNNER_CONFIG_SCRIPT = """
+su ubuntu <<'EOF'
+cd /home/ubuntu
+REGISTRATION_TOKEN="__REGISTRATION_TOKEN__"
+SAFE_NETWORK_REPO_URL="https://github.com/maidsafe/safe_network"
+IMDS_TOKEN=$(curl -s -X PUT "http://169.254.169.254/latest/api/token" \
+  -H "X-aws-ec2-metadata-token-ttl-seconds: 60")
+INSTANCE_ID=$(curl -s -H "X-aws-ec2-metadata-token: ${IMDS_TOKEN}" \
+  http://169.254.169.254/latest/meta-data/instance-id)
+RUNNER_NAME="__RUNNER_NAME_PREFIX__-${INSTANCE_ID}"
+
+cd /opt/actions-runner
+./config.sh --unattended --name "${RUNNER_NAME}" \
+  --url "${SAFE_NETWORK_REPO_URL}" --token "${REGISTRATION_TOKEN}" --labels "__RUNNER_LABELS__"
+EOF
+span_event config_done
+"""
+USER_DATA_SCRIPT = (
+    "#!/bin/bash\n"
+    + BOOT_TRACING_SCRIPT
+    + DATA_DISK_SCRIPT
+    + RUNNER_SETUP_SCRIPT
+    + SCCACHE_SCRIPT
+    + RUNNER_CONFIG_SCRIPT
+    + """
+(
+    cd /opt/actions-runner
+    ./svc.sh install ubuntu
+    ./svc.sh start
+)
+span_event service_started
+export_boot_span
+"""
+)
+# The user data for an instance in the warm pool. It's initialised in the same way, but the runner
+# service is only installed, not started, so the runner can't pick up a job yet. The instance then
+# stops itself, because it's launched with a shutdown behaviour of `stop`. The data volume is added
+# to fstab, and the service is enabled, so when the instance is started for a job, the volume is
+# mounted and the runner comes online without running any of this again. Instance store disks are
+# wiped when the instance stops, so only the EBS volume is used.
+WARM_POOL_USER_DATA_SCRIPT = (
+    "#!/bin/bash\n"
+    + BOOT_TRACING_SCRIPT
+    + "USE_INSTANCE_STORE=false\n"
+    + DATA_DISK_SCRIPT
+    + RUNNER_SETUP_SCRIPT
+    + SCCACHE_SCRIPT
+    + RUNNER_CONFIG_SCRIPT
+    + """
+echo "UUID=$(blkid -s UUID -o value "$DATA_DEVICE") /mnt/data ext4 noatime,nofail 0 2" >> /etc/fstab
+(
+    cd /opt/actions-runner
+    ./svc.sh install ubuntu
+)
+span_event service_installed
+export_boot_span
+shutdown -h now
+"""
+)
+# The user data for an ephemeral, just-in-time runner. The JIT config already contains the runner's
+# registration, so there's no `config.sh` step. The runner runs a single job, then exits, and the
+# instance shuts itself down. It's launched with a shutdown behaviour of `terminate`, so that also
+# terminates it.
+JIT_USER_DATA_SCRIPT = (
+    "#!/bin/bash\n"
+    + BOOT_TRACING_SCRIPT
+    + DATA_DISK_SCRIPT
+    + RUNNER_SETUP_SCRIPT
+    + SCCACHE_SCRIPT
+    + """
+span_event runner_started
+export_boot_span
+su ubuntu <<'EOF'
+cd /home/ubuntu
+JIT_CONFIG="__JIT_CONFIG__"
+
+cd /opt/actions-runner
+./run.sh --jitconfig "${JIT_CONFIG}"
+EOF
+shutdown -h now
+"""
+)
+SIGNATURE_HEADER = "X-Hub-Signature-256"
+DELIVERY_HEADER = "X-GitHub-Delivery"
+EVENT_HEADER = "X-GitHub-Event"
+# Every instance launched for a runner is tagged with this key, so the inventory only has to query
+# runner instances rather than everything in the account.
+RUNNER_TAG_KEY = "GhaRunner"
+RUNNER_NAME_PREFIX = "gha-runner"
+# The name of the runner on an instance, and the job and workflow run it was launched for.
+RUNNER_NAME_TAG_KEY = "RunnerName"
+JOB_ID_TAG_KEY = "JobId"
+RUN_ID_TAG_KEY = "RunId"
+# Instances in the warm pool have this tag. It's removed when an instance is taken from the pool.
+WARM_POOL_TAG_KEY = "WarmPool"
+# A runner that hasn't connected for 14 days is removed by Github, so instances are replaced well
+# before they've been in the pool that long.
+WARM_POOL_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+# How long a refill holds its lock, so that overlapping refills don't both launch instances.
+WARM_POOL_REFILL_LOCK_SECONDS = 60
+# When its job completes, a retained runner's instance is tagged with the time, so the sweeper can
+# tell how long it's been idle.
+IDLE_SINCE_TAG_KEY = "IdleSince"
+# How long an idle runner is claimed for a queued job. Github will have assigned it a job well
+# before then.
+IDLE_RUNNER_CLAIM_SECONDS = 2 * 60
+# How long a JIT runner's instance may run without the runner being busy before the sweeper
+# reclaims it. A runner picks up its job within minutes of its instance launching.
+DEFAULT_JIT_RUNNER_TTL_SECONDS = 30 * 60
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_API_VERSION = "2022-11-28"
+# The connect and read timeouts for requests to the Github API.
+GITHUB_REQUEST_TIMEOUT = (3.05, 10)
+GITHUB_MAX_RETRIES = 3
+# A secondary rate limit is only waited out if Github asks for a delay no longer than this;
+# otherwise the response is returned to the caller, rather than consuming the invocation.
+GITHUB_MAX_RETRY_AFTER_SECONDS = 10
+# Cleanup calls to the Github API, like removing runners, are deferred once less than this fraction
+# of the rate limit remains, so the rest is kept for launching runners.
+GITHUB_RATE_LIMIT_RESERVE = 0.2
+# Installation access tokens are valid for an hour. A new one is requested when the cached token is
+# this close to expiring, so a token that's handed out will remain valid for the rest of the
+# invocation.
+TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+# Registration tokens are also valid for an hour, but the runner only uses its token after the
+# instance has booted, so it needs more headroom. Within the first window a cached token is still
+# handed out, but a new one is requested in the background. Within the second, the token is
+# considered too close to expiry and the caller waits for a new one.
+REGISTRATION_TOKEN_BACKGROUND_REFRESH_SECONDS = 20 * 60
+REGISTRATION_TOKEN_REFRESH_MARGIN_SECONDS = 10 * 60
+# The labels every runner registers with.
+DEFAULT_RUNNER_LABELS = ("self-hosted",)
+# The runner release that's baked into the image, and the checksum of its archive, which is used to
+# verify it if an instance has to download it. These should match the `runner_version` and
+# `runner_sha256` the image was built with.
+DEFAULT_RUNNER_VERSION = "2.317.0"
+DEFAULT_RUNNER_SHA256 = (
+    "9e883d210df8c6028aff475475a457d380353f9d01877d51cc01a17b2a91161d"
+)
+# Each launch is tagged with the capacity pool that filled it.
+CAPACITY_POOL_TAG_KEY = "CapacityPool"
+# The errors that mean a capacity pool can't fill a request right now, so the next one is tried.
+CAPACITY_ERROR_CODES = {
+    "InsufficientInstanceCapacity",
+    "InsufficientCapacity",
+    "InstanceLimitExceeded",
+    "MaxSpotInstanceCountExceeded",
+    "SpotMaxPriceTooLow",
+    "Unsupported",
+}
+# The capacity errors that only apply to an availability zone, so a subnet in another zone may still
+# have capacity. The others are account limits, which apply wherever the instance is launched.
+ZONAL_CAPACITY_ERROR_CODES = {
+    "InsufficientInstanceCapacity",
+    "InsufficientCapacity",
+    "SpotMaxPriceTooLow",
+    "Unsupported",
+}
+# A capacity error counts against a subnet as if its launches took this much longer. The penalty
+# halves every PLACEMENT_ERROR_HALF_LIFE_SECONDS, so the subnet is tried again once its zone has had
+# time to recover.
+PLACEMENT_ERROR_PENALTY_SECONDS = 60
+PLACEMENT_ERROR_HALF_LIFE_SECONDS = 5 * 60
+# The weight of the latest launch in each subnet's moving average of launch latency.
+PLACEMENT_LATENCY_WEIGHT = 0.3
+# The device name of the data volume in the AMI's block device mappings.
+DATA_VOLUME_DEVICE_NAME = "/dev/sdb"
+# EC2 calls that are throttled or hit a server error are retried, with a jittered exponential
+# backoff, up to this many attempts in total.
+EC2_MAX_ATTEMPTS = 5
+EC2_BACKOFF_BASE_SECONDS = 0.5
+EC2_BACKOFF_MAX_SECONDS = 8
+EC2_RETRYABLE_ERROR_CODES = {
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "InternalError",
+    "InternalFailure",
+    "ServiceUnavailable",
+    "Unavailable",
+}
+# After this many consecutive calls to an operation have run out of attempts, its circuit opens,
+# and calls to it fail immediately until EC2_CIRCUIT_BREAKER_RESET_SECONDS have passed.
+EC2_CIRCUIT_BREAKER_THRESHOLD = 3
+EC2_CIRCUIT_BREAKER_RESET_SECONDS = 30
+# The CloudWatch namespace for the metrics emitted by the handlers.
+METRICS_NAMESPACE = "GhaRunners"
+# The dimensions every metric is reported with. A dimension that doesn't apply to an invocation,
+# such as the instance type when nothing was launched, has the value `none`.
+METRICS_DIMENSIONS = ["Function", "Action", "Outcome", "InstanceType"]
+# The service name the handlers' spans are reported under.
+TRACING_SERVICE_NAME = "manage-runners"
+# The connect and read timeouts for exporting spans. A collector that's down mustn't hold up a
+# launch.
+OTLP_EXPORT_TIMEOUT = (1, 2)
+# The most instance IDs TerminateInstances accepts in one request.
+EC2_TERMINATE_CHUNK_SIZE = 1000
+# The largest page size the runners API allows.
+RUNNERS_PAGE_SIZE = 100
+RUNNER_REMOVAL_WORKERS = 8
+RUNNER_REMOVAL_ATTEMPTS = 3
+RUNNER_REMOVAL_BACKOFF_SECONDS = 1
+# The time an attempt to remove a runner is allowed, so none is started without time to finish. An
+# attempt is a single request, because requests made against a deadline aren't retried by the
+# transport, and a `Retry-After` delay is only waited out if it leaves time for another request.
+RUNNER_REMOVAL_ATTEMPT_SECONDS = sum(GITHUB_REQUEST_TIMEOUT)
+# The time held back from removing runners, for terminating the instances and returning a response
+# before the Lambda times out.
+DEADLINE_RESERVE_SECONDS = 5
+# How long an event is remembered once it's been processed. Github redeliveries, whether automatic
+# or manual, happen well within this window.
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+# How long an event is claimed while it's being processed. It's just over the 30 second Lambda
+# timeout, so a claim held by a worker that died or timed out has expired by the time the queue
+# redelivers the event, after its 180 second visibility timeout.
+IDEMPOTENCY_IN_PROGRESS_TTL_SECONDS = 45
+# The response for a duplicate of an event that's still being processed.
+EVENT_IN_PROGRESS_RESPONSE = {
+    "statusCode": 202,
+    "body": "The event is already being processed",
+}
+# How long the timings of a job are kept for reports.
+JOB_TIMINGS_TTL_SECONDS = 30 * 24 * 60 * 60
+# The percentiles reported for the time jobs wait for a runner, and the time they run for.
+JOB_TIMING_PERCENTILES = (50, 95, 99)
+
+
+class ConfigurationError(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def parse_github_timestamp(timestamp):
+    """
+    Converts an ISO 8601 timestamp from the Github API to seconds since the epoch.
+
+    The API uses a `Z` suffix for UTC, which `fromisoformat` doesn't accept on Python 3.9.
+    """
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+
+
+class InvocationMetrics:
+    """
+    Collects the timings and counts for one invocation of a handler, to be emitted as a single
+    document in the CloudWatch embedded metric format (EMF).
+
+    Each phase of the handler is timed with `time`, and reported in milliseconds as a metric named
+    after the phase, e.g. `RunInstancesDuration`. A phase or count that's recorded more than once
+    is reported with all its values. The work done on other threads, like removing runners, is
+    recorded too, so everything is guarded by a lock.
+    """
+
+    def __init__(self, function_name, clock=time.perf_counter):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._values = {}
+        self.dimensions = {
+            "Function": function_name,
+            "Action": "none",
+            "Outcome": "none",
+            "InstanceType": "none",
+        }
+
+    def set_dimension(self, name, value):
+        with self._lock:
+            self.dimensions[name] = str(value)
+
+    def add(self, name, value, unit):
+        with self._lock:
+            self._values.setdefault(name, (unit, []))[1].append(value)
+
+    def increment(self, name, count=1):
+        self.add(name, count, "Count")
+
+    @contextmanager
+    def time(self, phase):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.add(f"{phase}Duration", (self._clock() - start) * 1000, "Milliseconds")
+
+    def to_emf(self, timestamp=None):
+        with self._lock:
+            document = {
+                "_aws": {
+                    "Timestamp": int((timestamp or time.time()) * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [METRICS_DIMENSIONS],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit}
+                                for name, (unit, _) in sorted(self._values.items())
+                            ],
+                        }
+                    ],
+                },
+            }
+            document.update(self.dimensions)
+            for name, (_, values) in self._values.items():
+                document[name] = values[0] if len(values) == 1 else values
+            return document
+
+
+class StdoutMetricsSink:
+    """
+    Writes each document to standard output. In Lambda, that's sent to CloudWatch Logs, which
+    extracts the metrics from the EMF documents without any calls to the CloudWatch API.
+    """
+
+    def emit(self, document):
+        print(json.dumps(document), flush=True)
+
+
+class InMemoryMetricsSink:
+    """
+    Keeps the documents in a list, so the metrics can be captured in tests and local runs.
+    """
+
+    def __init__(self):
+        self.documents = []
+
+    def emit(self, document):
+        self.documents.append(document)
+
+
+_metrics_sink = None
+_metrics_sink_lock = threading.Lock()
+_current_metrics = None
+
+
+def get_metrics_sink():
+    """
+    Gets the sink selected by `METRICS_BACKEND`, which is either `emf` or `memory`.
+    """
+    global _metrics_sink
+    with _metrics_sink_lock:
+        if _metrics_sink is None:
+            backend = os.getenv("METRICS_BACKEND", "emf")
+            if backend == "emf":
+                _metrics_sink = StdoutMetricsSink()
+            elif backend == "memory":
+                _metrics_sink = InMemoryMetricsSink()
+            else:
+                raise ConfigurationError(
+                    f"The METRICS_BACKEND variable has an unsupported value: {backend}"
+                )
+        return _metrics_sink
+
+
+def get_metrics():
+    """
+    Gets the metrics for the invocation that's being handled. Outside a handler, such as when a
+    function is called directly, what's recorded is discarded.
+    """
+    return _current_metrics or InvocationMetrics("none")
+
+
+def get_outcome(response):
+    if isinstance(response, dict) and response.get("batchItemFailures"):
+        return "partial"
+    status_code = response.get("statusCode", 200) if isinstance(response, dict) else 200
+    return "success" if status_code < 400 else "rejected"
+
+
+def instrumented(handler):
+    """
+    Times the handler and emits its metrics when it returns, with an outcome of `success`,
+    `partial`, `rejected` or `error`, unless the handler set a more specific one.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _current_metrics
+        metrics = InvocationMetrics(handler.__name__)
+        _current_metrics = metrics
+        try:
+            with metrics.time("Handler"):
+                response = handler(event, context)
+        except Exception:
+            metrics.set_dimension("Outcome", "error")
+            metrics.increment("Errors")
+            raise
+        else:
+            if metrics.dimensions["Outcome"] == "none":
+                metrics.set_dimension("Outcome", get_outcome(response))
+            return response
+        finally:
+            _current_metrics = None
+            try:
+                get_metrics_sink().emit(metrics.to_emf())
+            except Exception:
+                logger.exception("Failed to emit the metrics")
+
+    return wrapper
+
+
+class Span:
+    """
+    A span in a trace, which is exported in the OTLP/JSON encoding.
+
+    A span without a parent starts a new trace. Its `traceparent` is the W3C trace context that's
+    supplied to an instance with its user data, so the span for the boot of the instance is a child
+    of this one.
+    """
+
+    def __init__(self, name, parent=None, attributes=None, clock=time.time_ns):
+        self._clock = clock
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.error = False
+        self.start_time = clock()
+        self.end_time = None
+        # Every span in the trace is collected here, so the whole trace is exported together.
+        self.trace_spans = parent.trace_spans if parent else []
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name):
+        self.events.append((name, self._clock()))
+
+    def end(self):
+        self.end_time = self._clock()
+        self.trace_spans.append(self)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}}
+                for key, value in self.attributes.items()
+            ],
+            "events": [
+                {"name": name, "timeUnixNano": str(timestamp)}
+                for name, timestamp in self.events
+            ],
+            "status": {"code": 2 if self.error else 1},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+def get_otlp_trace_payload(spans):
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {
+                            "key": "service.name",
+                            "value": {"stringValue": TRACING_SERVICE_NAME},
+                        }
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "manage_runners"},
+                        "spans": [span.to_otlp() for span in spans],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+class OtlpSpanExporter:
+    """
+    Exports spans to an OpenTelemetry collector, with the OTLP/HTTP protocol and the JSON encoding,
+    so no OpenTelemetry packages need to be loaded on a cold start.
+    """
+
+    def __init__(self, endpoint):
+        self.url = f"{endpoint.rstrip('/')}/v1/traces"
+
+    def export(self, spans):
+        import requests
+
+        response = requests.post(
+            self.url, json=get_otlp_trace_payload(spans), timeout=OTLP_EXPORT_TIMEOUT
+        )
+        response.raise_for_status()
+
+
+class InMemorySpanExporter:
+    """
+    Keeps the exported spans in a list, so traces can be captured in tests and local runs.
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+_span_exporter = None
+_span_exporter_lock = threading.Lock()
+_current_span = None
+
+
+def get_span_exporter():
+    """
+    Gets the exporter selected by `TRACES_BACKEND`, which is either `otlp` or `memory`.
+
+    The `otlp` exporter sends spans to `OTEL_EXPORTER_OTLP_ENDPOINT`. If that isn't set, tracing
+    is off, and `None` is returned.
+    """
+    global _span_exporter
+    with _span_exporter_lock:
+        if _span_exporter is None:
+            backend = os.getenv("TRACES_BACKEND", "otlp")
+            if backend == "otlp":
+                endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+                if endpoint:
+                    _span_exporter = OtlpSpanExporter(endpoint)
+            elif backend == "memory":
+                _span_exporter = InMemorySpanExporter()
+            else:
+                raise ConfigurationError(
+                    f"The TRACES_BACKEND variable has an unsupported value: {backend}"
+                )
+        return _span_exporter
+
+
+def get_runner_otlp_endpoint():
+    """
+    Gets the endpoint the instances export their boot spans to. It defaults to the one the
+    handlers use, but the collector may be reached at a different address from inside the VPC.
+    """
+    return os.getenv("RUNNER_OTLP_ENDPOINT") or os.getenv(
+        "OTEL_EXPORTER_OTLP_ENDPOINT", ""
+    )
+
+
+def get_traceparent():
+    """
+    Gets the trace context of the current span, for an instance's user data, or an empty string if
+    there's no trace.
+    """
+    return _current_span.traceparent if _current_span else ""
+
+
+@contextmanager
+def start_span(name, attributes=None):
+    """
+    Starts a span, as a child of the current one if there is one. When a span without a parent
+    ends, its whole trace is exported. A failed export is logged, rather than failing the handler.
+    """
+    global _current_span
+    parent = _current_span
+    span = Span(name, parent, attributes)
+    _current_span = span
+    try:
+        yield span
+    except Exception:
+        span.error = True
+        raise
+    finally:
+        span.end()
+        _current_span = parent
+        if parent is None:
+            try:
+                exporter = get_span_exporter()
+                if exporter:
+                    exporter.export(span.trace_spans)
+            except Exception:
+                logger.exception(f"Failed to export the trace {span.trace_id}")
+
+
+class GithubClient:
+    """
+    A client for the Github API, with a connection-pooled session that's kept alive across warm
+    invocations of the Lambda.
+
+    Opening a new connection costs a TCP and TLS handshake with api.github.com, which is a
+    significant part of handling an event, so all requests should go through the shared client.
+
+    Every request uses the same default headers and timeouts. Server errors are retried with an
+    exponential backoff by the transport adapter, but only for idempotent methods. A POST that
+    timed out may still have been carried out, and retrying it could do it twice. If Github responds with a secondary rate limit,
+    indicated by a 403 or 429 with a `Retry-After` header, the request is retried after the
+    requested delay. The rate limit headers of every response are passed to the governor, except
+    for requests authenticated as the app with a JWT, which count against a separate limit from
+    the installation's and pass `track_rate_limit=False`.
+
+    A request made against a `deadline` isn't retried by the transport, and a `Retry-After` delay
+    is only waited out if there's still time for another request, so it can't run past the deadline.
+    """
+
+    def __init__(
+        self,
+        base_url=GITHUB_API_URL,
+        timeout=GITHUB_REQUEST_TIMEOUT,
+        max_retries=GITHUB_MAX_RETRIES,
+        sleep=time.sleep,
+    ):
+        self.base_url = base_url
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._sleep = sleep
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+            raise_on_status=False,
+        )
+        self.session = self._create_session(retry)
+        # Requests made against a deadline get a single attempt from the transport, so they can't
+        # run on past it.
+        self._single_attempt_session = self._create_session(0)
+
+    def _create_session(self, max_retries):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # The pool is sized for the threads that remove runners concurrently.
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=RUNNER_REMOVAL_WORKERS,
+            max_retries=max_retries,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.headers.update(
+            {
+                "Accept": "application/vnd.github+json",
+                "X-GitHub-Api-Version": GITHUB_API_VERSION,
+                "User-Agent": "maidsafe-manage-runners",
+            }
+        )
+        return session
+
+    def request(
+        self,
+        method,
+        path,
+        token=None,
+        headers=None,
+        track_rate_limit=True,
+        deadline=None,
+        **kwargs,
+    ):
+        url = path if path.startswith("https://") else f"{self.base_url}{path}"
+        request_headers = dict(headers or {})
+        if token:
+            request_headers["Authorization"] = f"Bearer {token}"
+        session = self.session if deadline is None else self._single_attempt_session
+        for attempt in range(self._max_retries + 1):
+            response = session.request(
+                method, url, headers=request_headers, timeout=self._timeout, **kwargs
+            )
+            if track_rate_limit:
+                github_rate_limit.update(response)
+            delay = self._get_retry_after(response)
+            if delay is None or attempt == self._max_retries:
+                return response
+            if deadline is not None and not deadline.allows(delay + sum(self._timeout)):
+                return response
+            logger.debug(
+                f"Secondary rate limit on {method} {url}; retrying in {delay}s"
+            )
+            self._sleep(delay)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def _get_retry_after(self, response):
+        if response.status_code not in (403, 429):
+            return None
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is None or not retry_after.isdigit():
+            return None
+        delay = int(retry_after)
+        if delay > GITHUB_MAX_RETRY_AFTER_SECONDS:
+            return None
+        return delay
+
+
+def get_int_header(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitGovernor:
+    """
+    Tracks the budget left in the Github API rate limit, from the headers of every response, across
+    warm invocations of the Lambda.
+
+    Each response has the `X-RateLimit-Remaining`, `X-RateLimit-Limit` and `X-RateLimit-Reset`
+    headers. Cleanup is only allowed while more than the `reserve` fraction of the limit remains,
+    so the rest of the budget is kept for the launch path. Once the budget is used up, or Github
+    asks for a `Retry-After` delay, no cleanup is allowed until the limit resets or the delay has
+    passed. The launch path is never held back: the worst that happens is that Github rejects its
+    requests, and it mostly uses cached tokens anyway.
+    """
+
+    def __init__(self, reserve=GITHUB_RATE_LIMIT_RESERVE, clock=time.time):
+        self._reserve = reserve
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._remaining = None
+        self._limit = None
+        self._reset_at = None
+        self._blocked_until = 0
+
+    def update(self, response):
+        headers = response.headers
+        remaining = get_int_header(headers, "X-RateLimit-Remaining")
+        limit = get_int_header(headers, "X-RateLimit-Limit")
+        reset_at = get_int_header(headers, "X-RateLimit-Reset")
+        retry_after = None
+        if response.status_code in (403, 429):
+            retry_after = get_int_header(headers, "Retry-After")
+        with self._lock:
+            if remaining is not None and limit and reset_at:
+                self._remaining = remaining
+                self._limit = limit
+                self._reset_at = reset_at
+                if remaining == 0:
+                    self._blocked_until = max(self._blocked_until, reset_at)
+            if retry_after:
+                self._blocked_until = max(
+                    self._blocked_until, self._clock() + retry_after
+                )
+
+    def allows_cleanup(self):
+        with self._lock:
+            now = self._clock()
+            if now < self._blocked_until:
+                return False
+            if self._reset_at is None or now >= self._reset_at:
+                return True
+            return self._remaining > self._limit * self._reserve
+
+
+github_rate_limit = RateLimitGovernor()
+_github_client = None
+_github_client_lock = threading.Lock()
+
+
+def get_github_client():
+    global _github_client
+    with _github_client_lock:
+        if _github_client is None:
+            _github_client = GithubClient()
+        return _github_client
+
+
+class InstallationTokenCache:
+    """
+    Caches the credentials for the installed Github App across warm invocations of the Lambda.
+
+    The parsed private key, the installation ID and the installation access token are all retained.
+    A new access token is only requested when the current one is within `refresh_margin` seconds of
+    the `expires_at` time returned with it. If the app ID or private key in the environment change,
+    everything is discarded.
+
+    All the state is guarded by a single lock, so the cache can be shared between threads. If
+    several threads find the token needs to be refreshed, only the first one will make the
+    requests and the others will receive the token it obtained.
+    """
+
+    def __init__(self, refresh_margin=TOKEN_REFRESH_MARGIN_SECONDS, clock=time.time):
+        self._refresh_margin = refresh_margin
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._private_key = None
+        self._installation_id = None
+        self._token = None
+        self._expires_at = 0
+
+    def get_token(self):
+        credentials = get_github_app_credentials()
+        with self._lock:
+            if credentials != self._credentials:
+                self._load_credentials(credentials)
+            if self._clock() >= self._expires_at - self._refresh_margin:
+                self._refresh_token()
+            return self._token
+
+    def invalidate(self):
+        with self._lock:
+            self._credentials = None
+            self._private_key = None
+            self._installation_id = None
+            self._token = None
+            self._expires_at = 0
+
+    def _load_credentials(self, credentials):
+        from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+        _, private_key_base64 = credentials
+        self._private_key = load_pem_private_key(
+            base64.b64decode(private_key_base64), password=None
+        )
+        self._credentials = credentials
+        self._installation_id = None
+        self._token = None
+        self._expires_at = 0
+
+    def _refresh_token(self):
+        import jwt
+
+        app_id, _ = self._credentials
+        iat = int(self._clock()) - 60
+        exp = int(self._clock()) + (10 * 60)
+        payload = {"iat": iat, "exp": exp, "iss": app_id}
+        encoded_jwt = jwt.encode(payload, self._private_key, algorithm="RS256")
+        client = get_github_client()
+        if self._installation_id is None:
+            response = client.get(
+                "/app/installations", token=encoded_jwt, track_rate_limit=False
+            )
+            if response.status_code != 200:
+                logger.debug(
+                    "Received unexpected response when requesting installation ID"
+                )
+                logger.debug(f"status_code: {response.status_code}")
+                logger.debug(f"text: {response.text}")
+                raise ConfigurationError(
+                    "Unexpected response indicates configuration issue"
+                )
+            self._installation_id = response.json()[0]["id"]
+
+        response = client.post(
+            f"/app/installations/{self._installation_id}/access_tokens",
+            token=encoded_jwt,
+            track_rate_limit=False,
+        )
+        if response.status_code != 201:
+            # The app may have been reinstalled, so the installation ID is looked up again next time.
+            self._installation_id = None
+            logger.debug("Received unexpected response when requesting access token")
+            logger.debug(f"status_code: {response.status_code}")
+            logger.debug(f"text: {response.text}")
+            raise ConfigurationError(
+                "Unexpected response indicates configuration issue"
+            )
+        json = response.json()
+        self._token = json["token"]
+        self._expires_at = parse_github_timestamp(json["expires_at"])
+        logger.debug(
+            f"Obtained installation access token expiring at {json['expires_at']}"
+        )
+
+
+installation_token_cache = InstallationTokenCache()
+
+
+def get_github_app_credentials():
+    app_id = os.getenv("GITHUB_APP_ID")
+    if not app_id:
+        raise ConfigurationError("The GITHUB_APP_ID variable must be set")
+    private_key_base64 = os.getenv("GITHUB_APP_PRIVATE_KEY_BASE64")
+    if not private_key_base64:
+        raise ConfigurationError(
+            "The GITHUB_APP_PRIVATE_KEY_BASE64 variable must be set"
+        )
+    return (app_id, private_key_base64)
+
+
+def get_installed_app_token():
+    """
+    Gets a token for the installed Github App, which can then be used for the APIs that require it,
+    such as requesting a registration token for a runner.
+
+    The Github documentation outlines the full process:
+    https://docs.github.com/en/developers/apps/building-github-apps/authenticating-with-github-apps#authenticating-as-a-github-app
+
+    The summary is:
+    * Use the private key registered with the runner app installed on the organisation to generate
+      a JWT. Github requires sending an issue time and an expiry time for the token. The minus 60
+      seconds is for "clock drift."
+    * Authenticate with that token to get the app installation ID.
+    * Make another request with the installation ID and the same JWT to get an access token.
+
+    The private key is a PEM, but it's assigned to an environment variable as a base64-encoded
+    string without any newline characters, to avoid any issues with that. We can't read it from a
+    file because this code is executing in the context of a Lambda function.
+
+    The access token is valid for an hour, so it's cached at module scope, along with the parsed key
+    and the installation ID. Most calls won't make any requests to Github at all.
+    """
+    with get_metrics().time("InstallationToken"):
+        return installation_token_cache.get_token()
+
+
+def request_registration_token():
+    token = get_installed_app_token()
+    response = get_github_client().post(
+        "/repos/maidsafe/safe_network/actions/runners/registration-token",
+        token=token,
+    )
+    if response.status_code != 201:
+        logger.debug("Received unexpected response when requesting registration token")
+        logger.debug(f"status_code: {response.status_code}")
+        logger.debug(f"text: {response.text}")
+        raise ConfigurationError("Unexpected response indicates configuration issue")
+    json = response.json()
+    return (json["token"], parse_github_timestamp(json["expires_at"]))
+
+
+class RegistrationTokenCache:
+    """
+    Pools the runner registration token across warm invocations of the Lambda.
+
+    The same registration token can be used to register any number of runners until it expires, so
+    in the common case, a `queued` event doesn't need to make any requests to Github.
+
+    When the cached token enters the `background_refresh` window, it's still returned, but a new
+    one is requested on another thread. The Lambda runtime freezes the process between invocations,
+    so that refresh may complete at the start of the next one. Only when the token is within
+    `refresh_margin` of expiring does the caller have to wait for a new one.
+    """
+
+    def __init__(
+        self,
+        fetch=request_registration_token,
+        background_refresh=REGISTRATION_TOKEN_BACKGROUND_REFRESH_SECONDS,
+        refresh_margin=REGISTRATION_TOKEN_REFRESH_MARGIN_SECONDS,
+        clock=time.time,
+    ):
+        self._fetch = fetch
+        self._background_refresh = background_refresh
+        self._refresh_margin = refresh_margin
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._refresh_thread = None
+
+    def get_token(self):
+        with self._lock:
+            remaining = self._expires_at - self._clock()
+            if remaining <= self._refresh_margin:
+                self._token, self._expires_at = self._fetch()
+            elif remaining <= self._background_refresh:
+                self._start_background_refresh()
+            return self._token
+
+    def prefetch(self):
+        """
+        Populates the cache, for use during the init phase of the Lambda.
+
+        Any failure is logged rather than raised, because the token will be requested again when
+        it's needed.
+        """
+        try:
+            self.get_token()
+        except Exception:
+            logger.exception("Failed to prefetch the registration token")
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+
+    def _start_background_refresh(self):
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(
+            target=self._refresh_in_background, daemon=True
+        )
+        self._refresh_thread.start()
+
+    def _refresh_in_background(self):
+        try:
+            token, expires_at = self._fetch()
+        except Exception:
+            logger.exception(
+                "Failed to refresh the registration token in the background"
+            )
+            return
+        with self._lock:
+            if expires_at > self._expires_at:
+                self._token, self._expires_at = (token, expires_at)
+
+
+registration_token_cache = RegistrationTokenCache()
+
+
+def get_registration_token():
+    with get_metrics().time("RegistrationToken"):
+        return registration_token_cache.get_token()
+
+
+Runner = namedtuple("Runner", ["id", "name", "status", "busy", "labels"])
+# The settings an instance is launched with. The `labels` are the `runs-on` labels a job must have
+# for the profile to be used, and the runner registers with them.
+LaunchProfile = namedtuple(
+    "LaunchProfile",
+    [
+        "name",
+        "labels",
+        "ami_id",
+        "instance_types",
+        "spot",
+        "subnet_ids",
+        "volume_size",
+        "iam_instance_profile",
+        "key_name",
+        "security_group_id",
+    ],
+)
+# An instance type, bought on the `spot` or `on-demand` market.
+CapacityPool = namedtuple("CapacityPool", ["instance_type", "market"])
+# When a job was queued, started and completed, in seconds since the epoch, and what it ran on.
+JobTiming = namedtuple(
+    "JobTiming",
+    ["job_id", "labels", "instance_type", "queued_at", "started_at", "completed_at"],
+)
+# The S3 bucket that backs the shared compilation cache, and how to reach it.
+SccacheConfig = namedtuple(
+    "SccacheConfig", ["bucket", "region", "endpoint", "key_prefix"]
+)
+ScaleDownPolicy = namedtuple(
+    "ScaleDownPolicy", ["min_idle_runners", "idle_ttl_seconds", "cooldown_seconds"]
+)
+
+
+class RunnerCollection:
+    """
+    The runners registered with the repository, indexed by ID, name, status and busy flag.
+    """
+
+    def __init__(self, runners):
+        self.runners = runners
+        self.by_id = {runner.id: runner for runner in runners}
+        self.by_name = {runner.name: runner for runner in runners}
+        self._by_status = {}
+        self._by_busy = {True: [], False: []}
+        for runner in runners:
+            self._by_status.setdefault(runner.status, []).append(runner)
+            self._by_busy[runner.busy].append(runner)
+
+    def __iter__(self):
+        return iter(self.runners)
+
+    def __len__(self):
+        return len(self.runners)
+
+    def with_status(self, status):
+        return list(self._by_status.get(status, []))
+
+    def busy(self):
+        return list(self._by_busy[True])
+
+    def idle(self):
+        return list(self._by_busy[False])
+
+    @classmethod
+    def from_json(cls, runners_json):
+        return cls(
+            [
+                Runner(
+                    id=x["id"],
+                    name=x["name"],
+                    status=x["status"],
+                    busy=x["busy"],
+                    labels=tuple(label["name"] for label in x.get("labels", [])),
+                )
+                for x in runners_json
+            ]
+        )
+
+
+class ConditionalGetCache:
+    """
+    Remembers the ETag, body and next page link of responses, keyed by URL.
+
+    A request for a URL that has been fetched before sends `If-None-Match`, and if Github responds
+    with a 304, the remembered body is used. The 304 response has no body to download, and it
+    doesn't count against the rate limit. The cache lives at module scope, so it's retained across
+    warm invocations.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, url, token):
+        with self._lock:
+            entry = self._entries.get(url)
+        headers = {"If-None-Match": entry[0]} if entry else {}
+        response = get_github_client().get(url, token=token, headers=headers)
+        if response.status_code == 304 and entry:
+            _, body, next_url = entry
+            return (body, next_url)
+        if response.status_code != 200:
+            logger.debug(f"Received unexpected response when requesting {url}")
+            logger.debug(f"status_code: {response.status_code}")
+            logger.debug(f"text: {response.text}")
+            raise ConfigurationError(
+                "Unexpected response indicates configuration issue"
+            )
+        body = response.json()
+        next_url = response.links.get("next", {}).get("url")
+        etag = response.headers.get("ETag")
+        if etag:
+            with self._lock:
+                self._entries[url] = (etag, body, next_url)
+        return (body, next_url)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+runner_listing_cache = ConditionalGetCache()
+
+
+def list_runners():
+    """
+    Gets all the runners registered with the repository, following the `Link` header through every
+    page of results.
+    """
+    token = get_installed_app_token()
+    url = f"/repos/maidsafe/safe_network/actions/runners?per_page={RUNNERS_PAGE_SIZE}"
+    runners_json = []
+    while url:
+        body, url = runner_listing_cache.get(url, token)
+        runners_json.extend(body["runners"])
+    return RunnerCollection.from_json(runners_json)
+
+
+def remove_runner(id, deadline=None):
+    token = get_installed_app_token()
+    response = get_github_client().delete(
+        f"/repos/maidsafe/safe_network/actions/runners/{id}",
+        token=token,
+        deadline=deadline,
+    )
+    return response.status_code
+
+
+class Deadline:
+    """
+    Tracks how long the current invocation has left before the Lambda times out.
+
+    The time remaining is read from the Lambda context, less a reserve for finishing up. When there
+    is no context, for example when the handler is called directly, there is no deadline.
+    """
+
+    def __init__(self, context, reserve=DEADLINE_RESERVE_SECONDS, clock=time.monotonic):
+        self._clock = clock
+        self._expires_at = None
+        if hasattr(context, "get_remaining_time_in_millis"):
+            remaining = context.get_remaining_time_in_millis() / 1000
+            self._expires_at = clock() + remaining - reserve
+
+    def remaining(self):
+        if self._expires_at is None:
+            return None
+        return max(0, self._expires_at - self._clock())
+
+    def allows(self, seconds):
+        remaining = self.remaining()
+        return remaining is None or remaining > seconds
+
+
+def remove_runner_with_retries(id, deadline):
+    """
+    Removes the runner, retrying with a backoff if Github doesn't accept the request.
+
+    The `workflow_job` event may be received before the runner is marked as idle, in which case the
+    deletion is rejected, so it's worth trying again after a short wait. No attempt is started if
+    the deadline doesn't leave time for it to finish, or if the Github rate limit is running low.
+
+    Returns "removed", "failed" or "deferred".
+    """
+    import requests
+
+    for attempt in range(RUNNER_REMOVAL_ATTEMPTS):
+        backoff = (
+            RUNNER_REMOVAL_BACKOFF_SECONDS * (2 ** (attempt - 1)) if attempt else 0
+        )
+        if (
+            not deadline.allows(backoff + RUNNER_REMOVAL_ATTEMPT_SECONDS)
+            or not github_rate_limit.allows_cleanup()
+        ):
+            return "deferred"
+        if backoff:
+            time.sleep(backoff)
+        try:
+            status_code = remove_runner(id, deadline)
+        except requests.RequestException as e:
+            logger.debug(f"Request to remove runner {id} failed: {e}")
+            continue
+        # A 404 means the runner was already removed, which is the outcome we want.
+        if status_code in (204, 404):
+            return "removed"
+        logger.debug(f"Attempt to remove runner {id} returned {status_code}")
+    return "failed"
+
+
+def remove_runners(runner_ids, deadline):
+    """
+    Removes the runners concurrently, on a bounded pool of threads.
+
+    Once the deadline passes, removals that haven't started are cancelled, but those in flight are
+    waited for, so a runner is never reported as deferred after it's been removed, which would
+    leave its instance running. An attempt is only started if there's time for it to finish, so
+    waiting doesn't run past the deadline.
+
+    Runners that can't be removed before the deadline are reported as deferred. They remain
+    registered and idle, and are left for the sweeper, which removes the runners of instances
+    tagged with `IdleSince`.
+    """
+    results = {"removed": [], "failed": [], "deferred": []}
+    if not runner_ids:
+        return results
+    executor = ThreadPoolExecutor(
+        max_workers=min(RUNNER_REMOVAL_WORKERS, len(runner_ids))
+    )
+    futures = [
+        executor.submit(remove_runner_with_retries, id, deadline) for id in runner_ids
+    ]
+    _, not_done = wait(futures, timeout=deadline.remaining())
+    for future in not_done:
+        future.cancel()
+    executor.shutdown(wait=True)
+    for id, future in zip(runner_ids, futures):
+        if future.cancelled():
+            outcome = "deferred"
+        elif future.exception():
+            logger.debug(f"Failed to remove runner {id}: {future.exception()}")
+            outcome = "failed"
+        else:
+            outcome = future.result()
+        results[outcome].append(id)
+    return results
+
+
+class RunnerInventory:
+    """
+    An index of running runner instances, keyed by runner name.
+
+    The runner name is taken from the `RunnerName` tag. Instances launched before runners were
+    named after their instance registered using the hostname, which is the first label of the
+    private DNS name, e.g. `ip-10-0-0-128`, so that's indexed too. Each lookup is a single
+    dictionary access, so reconciling runners against instances is linear in the number of runners.
+    """
+
+    def __init__(self, instances):
+        self.instances = instances
+        self._by_runner_name = {}
+        for instance in instances:
+            private_dns = instance.get("PrivateDnsName")
+            if private_dns:
+                self._by_runner_name[private_dns.split(".")[0]] = instance
+            runner_name = get_instance_tag(instance, RUNNER_NAME_TAG_KEY)
+            if runner_name:
+                self._by_runner_name[runner_name] = instance
+
+    def __len__(self):
+        return len(self.instances)
+
+    def find_by_runner_name(self, runner_name):
+        return self._by_runner_name.get(runner_name)
+
+
+def get_instance_tag(instance, key):
+    for tag in instance.get("Tags", []):
+        if tag["Key"] == key:
+            return tag["Value"]
+    return None
+
+
+_aws_clients = {}
+_aws_clients_lock = threading.Lock()
+
+
+def get_aws_client(service_name):
+    """
+    Gets a client for the AWS service, which is created on first use and then reused across warm
+    invocations.
+    """
+    with _aws_clients_lock:
+        if service_name not in _aws_clients:
+            import boto3
+
+            _aws_clients[service_name] = boto3.client(service_name)
+        return _aws_clients[service_name]
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an operation that keeps failing, so a throttled API isn't made worse, and the
+    invocation doesn't spend its time waiting on it.
+
+    After `threshold` consecutive failures the circuit opens, and calls are refused until
+    `reset_seconds` have passed. Then a single trial call is let through: if it succeeds the
+    circuit closes, otherwise it opens again.
+    """
+
+    def __init__(
+        self,
+        threshold=EC2_CIRCUIT_BREAKER_THRESHOLD,
+        reset_seconds=EC2_CIRCUIT_BREAKER_RESET_SECONDS,
+        clock=time.monotonic,
+    ):
+        self._threshold = threshold
+        self._reset_seconds = reset_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    def allows(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._clock() - self._opened_at >= self._reset_seconds:
+                # Let one trial call through, and hold the others back until it's finished.
+                self._opened_at = self._clock()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self._threshold:
+                self._opened_at = self._clock()
+
+
+class Ec2Gateway:
+    """
+    Wraps the EC2 client, so that every call is retried when EC2 throttles it, and an operation
+    that keeps failing is cut off by its own circuit breaker.
+
+    Throttling and server errors are retried with a full-jitter exponential backoff, so a burst of
+    invocations doesn't retry in lockstep, and so are connection errors and timeouts, which are
+    recorded on the breaker in the same way. Any other error is raised straight away. Launches are
+    given a `ClientToken`, so a retried RunInstances request can't launch the instances twice.
+    Terminations are split into chunks that TerminateInstances accepts, and an empty one isn't
+    sent at all.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_attempts=EC2_MAX_ATTEMPTS,
+        sleep=time.sleep,
+        clock=time.monotonic,
+    ):
+        self._client = client
+        self._max_attempts = max_attempts
+        self._sleep = sleep
+        self._clock = clock
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def _get_breaker(self, operation_name):
+        with self._breakers_lock:
+            if operation_name not in self._breakers:
+                self._breakers[operation_name] = CircuitBreaker(clock=self._clock)
+            return self._breakers[operation_name]
+
+    def call(self, operation_name, operation, **kwargs):
+        from botocore.exceptions import ClientError, HTTPClientError
+        from botocore.exceptions import ConnectionError as BotoConnectionError
+
+        breaker = self._get_breaker(operation_name)
+        if not breaker.allows():
+            raise CircuitOpenError(f"The circuit for EC2 {operation_name} is open")
+        for attempt in range(self._max_attempts):
+            try:
+                result = operation(**kwargs)
+            except (ClientError, BotoConnectionError, HTTPClientError) as error:
+                if isinstance(error, ClientError):
+                    code = error.response.get("Error", {}).get("Code")
+                    if code not in EC2_RETRYABLE_ERROR_CODES:
+                        # EC2 answered, so the operation is working.
+                        breaker.record_success()
+                        raise
+                else:
+                    code = type(error).__name__
+                if attempt == self._max_attempts - 1:
+                    breaker.record_failure()
+                    raise
+                delay = random.uniform(
+                    0,
+                    min(EC2_BACKOFF_MAX_SECONDS, EC2_BACKOFF_BASE_SECONDS * 2**attempt),
+                )
+                logger.debug(
+                    f"EC2 {operation_name} failed with {code}; retrying in {delay:.2f}s"
+                )
+                self._sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+    def run_instances(self, **kwargs):
+        kwargs.setdefault("ClientToken", str(uuid.uuid4()))
+        return self.call("run_instances", self._client.run_instances, **kwargs)
+
+    def describe_instances(self, **kwargs):
+        return self.call(
+            "describe_instances", self._client.describe_instances, **kwargs
+        )
+
+    def start_instances(self, **kwargs):
+        return self.call("start_instances", self._client.start_instances, **kwargs)
+
+    def create_tags(self, **kwargs):
+        return self.call("create_tags", self._client.create_tags, **kwargs)
+
+    def delete_tags(self, **kwargs):
+        return self.call("delete_tags", self._client.delete_tags, **kwargs)
+
+    def terminate_instances(self, InstanceIds, **kwargs):
+        get_metrics().increment("Terminations", len(InstanceIds))
+        terminating = []
+        for start in range(0, len(InstanceIds), EC2_TERMINATE_CHUNK_SIZE):
+            response = self.call(
+                "terminate_instances",
+                self._client.terminate_instances,
+                InstanceIds=InstanceIds[start : start + EC2_TERMINATE_CHUNK_SIZE],
+                **kwargs,
+            )
+            terminating.extend(response.get("TerminatingInstances", []))
+        return {"TerminatingInstances": terminating}
+
+    def get_paginator(self, operation_name):
+        return Ec2Paginator(
+            self, operation_name, self._client.get_paginator(operation_name)
+        )
+
+
+class Ec2Paginator:
+    """
+    A paginator whose pages are all fetched through the gateway. If a page is throttled, the whole
+    listing is retried, so the result is always a complete one.
+    """
+
+    def __init__(self, gateway, operation_name, paginator):
+        self._gateway = gateway
+        self._operation_name = operation_name
+        self._paginator = paginator
+
+    def paginate(self, **kwargs):
+        return self._gateway.call(
+            self._operation_name,
+            lambda **request: list(self._paginator.paginate(**request)),
+            **kwargs,
+        )
+
+
+_ec2_gateway = None
+_ec2_gateway_lock = threading.Lock()
+
+
+def get_ec2_client():
+    """
+    Gets the EC2 gateway, which is created on first use and then reused across warm invocations, so
+    its circuit breakers remember recent failures.
+
+    The gateway does the retrying, so the client's own retries are turned off.
+    """
+    global _ec2_gateway
+    with _ec2_gateway_lock:
+        if _ec2_gateway is None:
+            import boto3
+            from botocore.config import Config
+
+            client = boto3.client(
+                "ec2", config=Config(retries={"mode": "standard", "max_attempts": 1})
+            )
+            _ec2_gateway = Ec2Gateway(client)
+        return _ec2_gateway
+
+
+def get_runner_inventory(client):
+    """
+    Gets all the running runner instances, following every page of results.
+
+    The query is filtered by the runner tag and the `running` state, so the size of the response
+    doesn't depend on whatever else is in the account.
+    """
+    paginator = client.get_paginator("describe_instances")
+    pages = paginator.paginate(
+        Filters=[
+            {"Name": f"tag:{RUNNER_TAG_KEY}", "Values": ["true"]},
+            {"Name": "instance-state-name", "Values": ["running"]},
+        ]
+    )
+    instances = [
+        instance
+        for page in pages
+        for reservation in page["Reservations"]
+        for instance in reservation["Instances"]
+    ]
+    logger.debug(f"Found {len(instances)} running runner instances")
+    return RunnerInventory(instances)
+
+
+def find_runner_instance(client, tag_key, tag_value):
+    """
+    Finds the running runner instance with the tag, using a single filtered query rather than a
+    scan of every runner instance.
+    """
+    response = client.describe_instances(
+        Filters=[
+            {"Name": f"tag:{RUNNER_TAG_KEY}", "Values": ["true"]},
+            {"Name": f"tag:{tag_key}", "Values": [tag_value]},
+            {"Name": "instance-state-name", "Values": ["running"]},
+        ]
+    )
+    instances = [
+        instance
+        for reservation in response["Reservations"]
+        for instance in reservation["Instances"]
+    ]
+    if len(instances) > 1:
+        logger.debug(f"Found {len(instances)} instances tagged {tag_key}={tag_value}")
+    return instances[0] if instances else None
+
+
+def tag_runner_instance(instance_id, runner_name, workflow_job=None):
+    """
+    Tags the instance with the name of its runner and the job it was launched for, if any.
+
+    A persistent runner is named after its instance, so the tags can't be supplied with the launch
+    request. A failure is logged rather than raised, because raising would have the job retried
+    and launch another instance.
+    """
+    tags = [{"Key": RUNNER_NAME_TAG_KEY, "Value": runner_name}]
+    if workflow_job:
+        job = workflow_job["workflow_job"]
+        tags.append({"Key": JOB_ID_TAG_KEY, "Value": str(job["id"])})
+        tags.append({"Key": RUN_ID_TAG_KEY, "Value": str(job["run_id"])})
+    try:
+        get_ec2_client().create_tags(Resources=[instance_id], Tags=tags)
+    except Exception:
+        logger.exception(f"Failed to tag instance {instance_id}")
+
+
+def get_user_data_script(
+    registration_token,
+    labels=DEFAULT_RUNNER_LABELS,
+    script=USER_DATA_SCRIPT,
+    traceparent="",
+):
+    # This is only really in its own function for testing purposes.
+    # You can 'spy' on it and check the return value.
+    user_data_script_with_token = (
+        script.replace("__REGISTRATION_TOKEN__", registration_token)
+        .replace("__RUNNER_NAME_PREFIX__", RUNNER_NAME_PREFIX)
+        .replace("__RUNNER_LABELS__", ",".join(labels))
+    )
+    return get_traced_user_data_script(
+        get_sccache_script(get_runner_setup_script(user_data_script_with_token)),
+        traceparent,
+    )
+
+
+def get_jit_user_data_script(encoded_jit_config, traceparent=""):
+    return get_traced_user_data_script(
+        get_sccache_script(
+            get_runner_setup_script(
+                JIT_USER_DATA_SCRIPT.replace("__JIT_CONFIG__", encoded_jit_config)
+            )
+        ),
+        traceparent,
+    )
+
+
+def get_runner_release():
+    """
+    Gets the runner version selected by `RUNNER_VERSION`, and the checksum of its archive from
+    `RUNNER_SHA256`.
+
+    A version other than the default needs its own checksum, otherwise an instance whose image
+    doesn't have it would have nothing to verify the download against.
+    """
+    version = os.getenv("RUNNER_VERSION") or DEFAULT_RUNNER_VERSION
+    sha256 = os.getenv("RUNNER_SHA256")
+    if not sha256:
+        if version != DEFAULT_RUNNER_VERSION:
+            raise ConfigurationError(
+                "The RUNNER_SHA256 variable must be set when RUNNER_VERSION is"
+            )
+        sha256 = DEFAULT_RUNNER_SHA256
+    return (version, sha256.lower())
+
+
+def get_runner_setup_script(script):
+    version, sha256 = get_runner_release()
+    return script.replace("__RUNNER_VERSION__", version).replace(
+        "__RUNNER_SHA256__", sha256
+    )
+
+
+def get_sccache_config():
+    """
+    Gets the shared compilation cache selected by `SCCACHE_BUCKET`, or `None` if there isn't one.
+
+    The bucket is in `SCCACHE_REGION`, or the function's own region. `SCCACHE_ENDPOINT` points the
+    cache at another S3-compatible service, like MinIO, and `SCCACHE_KEY_PREFIX` sets where in the
+    bucket the objects are kept.
+    """
+    bucket = os.getenv("SCCACHE_BUCKET")
+    if not bucket:
+        return None
+    region = os.getenv("SCCACHE_REGION") or os.getenv("AWS_REGION")
+    if not region:
+        raise ConfigurationError("The SCCACHE_REGION variable must be set")
+    return SccacheConfig(
+        bucket=bucket,
+        region=region,
+        endpoint=os.getenv("SCCACHE_ENDPOINT", ""),
+        key_prefix=os.getenv("SCCACHE_KEY_PREFIX", "sccache").strip("/"),
+    )
+
+
+def get_sccache_script(script):
+    config = get_sccache_config() or SccacheConfig("", "", "", "")
+    return (
+        script.replace("__SCCACHE_BUCKET__", config.bucket)
+        .replace("__SCCACHE_REGION__", config.region)
+        .replace("__SCCACHE_ENDPOINT__", config.endpoint)
+        .replace("__SCCACHE_KEY_PREFIX__", config.key_prefix)
+        .replace("__METRICS_NAMESPACE__", METRICS_NAMESPACE)
+    )
+
+
+def get_traced_user_data_script(script, traceparent):
+    return script.replace("__TRACEPARENT__", traceparent).replace(
+        "__OTLP_ENDPOINT__", get_runner_otlp_endpoint() if traceparent else ""
+    )
+
+
+def get_runner_mode():
+    """
+    Gets the mode selected by `RUNNER_MODE`.
+
+    In `persistent` mode, each instance registers a runner that stays registered until the instance
+    is terminated, when a `completed` event finds it idle. In `jit` mode, each queued job gets its
+    own ephemeral runner, which is removed by Github after it has run the job.
+    """
+    mode = os.getenv("RUNNER_MODE", "persistent")
+    if mode not in ("persistent", "jit"):
+        raise ConfigurationError(
+            f"The RUNNER_MODE variable has an unsupported value: {mode}"
+        )
+    return mode
+
+
+def get_jit_runner_name(job_id):
+    return f"{RUNNER_NAME_PREFIX}-{job_id}"
+
+
+def get_persistent_runner_name(instance_id):
+    return f"{RUNNER_NAME_PREFIX}-{instance_id}"
+
+
+def get_runner_group_id():
+    """
+    Gets the runner group that JIT runners are registered in, from `RUNNER_GROUP_ID`. The default
+    group has the ID 1.
+    """
+    value = os.getenv("RUNNER_GROUP_ID", "1")
+    try:
+        return int(value)
+    except ValueError:
+        raise ConfigurationError(
+            f"The RUNNER_GROUP_ID variable has an unsupported value: {value}"
+        )
+
+
+def generate_jit_config(runner_name, labels):
+    """
+    Creates an ephemeral runner that can only run a single job, and returns its ID and encoded
+    configuration.
+
+    https://docs.github.com/en/rest/actions/self-hosted-runners#create-configuration-for-a-just-in-time-runner-for-a-repository
+
+    If a runner with the name is already registered, it's most likely because the response to an
+    earlier request was lost, so the runner never got an instance. It's removed and the config is
+    generated again, or every retry of the job would fail in the same way.
+    """
+    response = request_jit_config(runner_name, labels)
+    if response.status_code == 409:
+        runner = list_runners().by_name.get(runner_name)
+        if runner and not runner.busy:
+            logger.debug(
+                f"Removing runner {runner.id}, left over from an earlier attempt"
+            )
+            remove_runner(runner.id)
+            response = request_jit_config(runner_name, labels)
+    if response.status_code != 201:
+        logger.debug("Received unexpected response when generating JIT config")
+        logger.debug(f"status_code: {response.status_code}")
+        logger.debug(f"text: {response.text}")
+        raise ConfigurationError("Unexpected response indicates configuration issue")
+    jit_config = response.json()
+    return (jit_config["runner"]["id"], jit_config["encoded_jit_config"])
+
+
+def request_jit_config(runner_name, labels):
+    token = get_installed_app_token()
+    return get_github_client().post(
+        "/repos/maidsafe/safe_network/actions/runners/generate-jitconfig",
+        token=token,
+        json={
+            "name": runner_name,
+            "runner_group_id": get_runner_group_id(),
+            "labels": labels,
+            "work_folder": "_work",
+        },
+    )
+
+
+def launch_jit_instance(workflow_job):
+    """
+    Launches an instance with an ephemeral runner for the job.
+
+    Each instance needs its own JIT config, so unlike persistent runners, these can't share a
+    launch request.
+
+    The runner is registered when its config is generated, and it's named after the job, so if the
+    launch fails, the runner is removed again. Otherwise a retry couldn't register it.
+    """
+    job = workflow_job["workflow_job"]
+    runner_name = get_jit_runner_name(job["id"])
+    runner_id, encoded_jit_config = generate_jit_config(runner_name, job["labels"])
+    try:
+        instance_ids = launch_instances(
+            1,
+            profile=get_launch_profiles().match(job["labels"]),
+            user_data=get_jit_user_data_script(encoded_jit_config, get_traceparent()),
+            InstanceInitiatedShutdownBehavior="terminate",
+        )
+    except Exception:
+        try:
+            status_code = remove_runner(runner_id)
+            logger.debug(f"Removed JIT runner {runner_name}: {status_code}")
+        except Exception:
+            logger.exception(f"Failed to remove JIT runner {runner_name}")
+        raise
+    logger.debug(f"Launched {instance_ids[0]} with JIT runner {runner_name}")
+    tag_runner_instance(instance_ids[0], runner_name, workflow_job)
+    return instance_ids[0]
+
+
+def release_jit_runner(job):
+    """
+    Hands the instance launched for a job that was cancelled before a runner picked it up over to
+    the sweeper, by tagging it with `IdleSince`.
+
+    A runner that ran the job removes itself, and its instance shuts itself down, so there's nothing
+    to do. But the runner launched for a cancelled job may never be given one.
+    """
+    if job.get("runner_name"):
+        logger.debug("The ephemeral runner and its instance will remove themselves")
+        return {
+            "statusCode": 200,
+            "body": "The ephemeral runner and its instance will remove themselves",
+        }
+    client = get_ec2_client()
+    instance = find_runner_instance(client, JOB_ID_TAG_KEY, str(job["id"]))
+    if not instance:
+        logger.debug(f"No runner instance to release for job {job['id']}")
+        return {"statusCode": 200, "body": "No runner instance to release for the job"}
+    instance_id = instance["InstanceId"]
+    client.create_tags(
+        Resources=[instance_id],
+        Tags=[{"Key": IDLE_SINCE_TAG_KEY, "Value": str(int(time.time()))}],
+    )
+    logger.debug(f"Released {instance_id}, launched for cancelled job {job['id']}")
+    return {"statusCode": 200, "ReleasedInstanceIds": [instance_id]}
+
+
+def launch_persistent_instance(workflow_job):
+    """
+    Starts an instance from the warm pool for the job, or if the pool is empty, launches one.
+
+    The warm pool is launched with the default profile, so it's only used for jobs that match it.
+    """
+    profiles = get_launch_profiles()
+    profile = profiles.match(workflow_job["workflow_job"]["labels"])
+    warm_instance_ids = []
+    if profile == profiles.default:
+        warm_instance_ids = take_warm_instances(1)
+    if warm_instance_ids:
+        instance_id = warm_instance_ids[0]
+        logger.debug(f"Took {instance_id} from the warm pool")
+    else:
+        instance_id = launch_instances(1, profile=profile)[0]
+    record_scale_up()
+    tag_runner_instance(
+        instance_id, get_persistent_runner_name(instance_id), workflow_job
+    )
+    return instance_id
+
+
+def launch_instances(
+    count, profile=None, user_data=None, tags=None, allow_spot=True, **kwargs
+):
+    """
+    Launches up to `count` runner instances, with as few RunInstances requests as capacity allows.
+
+    The instances use the settings from the launch `profile`, or the default profile if none is
+    given. Unless other `user_data` is supplied, the instances register persistent runners. The
+    registration token can be used by any number of runners, so every instance is given the same
+    user data. If EC2 is short on capacity it may launch fewer instances than requested, so the
+    caller must check how many IDs are returned.
+
+    Any `tags` are added to the runner tag, and any other keyword arguments are passed through to
+    RunInstances. Spot capacity is only used if the profile and `allow_spot` both allow it.
+    """
+    if profile is None:
+        profile = get_launch_profiles().default
+    if user_data is None:
+        registration_token = get_registration_token()
+        user_data = get_user_data_script(
+            registration_token,
+            get_runner_labels(profile),
+            traceparent=get_traceparent(),
+        )
+    if profile.volume_size:
+        kwargs["BlockDeviceMappings"] = [
+            {
+                "DeviceName": DATA_VOLUME_DEVICE_NAME,
+                "Ebs": {
+                    "VolumeSize": profile.volume_size,
+                    "VolumeType": "gp3",
+                    "DeleteOnTermination": True,
+                },
+            }
+        ]
+    fills = launch_in_capacity_pools(
+        get_capacity_pools(profile, allow_spot),
+        count,
+        IamInstanceProfile={"Arn": profile.iam_instance_profile},
+        ImageId=profile.ami_id,
+        KeyName=profile.key_name,
+        SecurityGroupIds=[profile.security_group_id],
+        UserData=user_data,
+        subnet_ids=profile.subnet_ids,
+        tags=[{"Key": RUNNER_TAG_KEY, "Value": "true"}] + (tags or []),
+        **kwargs,
+    )
+    for pool, instance_ids in fills:
+        logger.debug(
+            f"The {pool.instance_type} {pool.market} pool filled {len(instance_ids)} "
+            f"of {count} instances for the {profile.name} profile"
+        )
+    return [instance_id for (_, instance_ids) in fills for instance_id in instance_ids]
+
+
+def get_capacity_pools(profile, allow_spot=True):
+    """
+    Gets the capacity pools to request instances from, in order of preference.
+
+    If the profile uses spot, every instance type is tried on the spot market first, then on
+    demand, so a job is never left waiting because spot capacity has run out.
+    """
+    markets = ["on-demand"]
+    if profile.spot and allow_spot:
+        markets.insert(0, "spot")
+    return [
+        CapacityPool(instance_type, market)
+        for market in markets
+        for instance_type in profile.instance_types
+    ]
+
+
+def launch_in_capacity_pools(pools, count, tags, subnet_ids, **request):
+    """
+    Requests instances from each capacity pool in turn, until `count` instances are running.
+
+    Each pool is tried in every subnet, healthiest first, before moving on to the next pool. A
+    subnet that has no capacity for the pool is skipped, and one that can only partly fill the
+    request is asked for what it can, with the rest requested from the next subnet. Returns a list
+    of `(pool, instance_ids)` pairs for the launches that filled the request. If nothing could be
+    launched, the last capacity error is raised.
+    """
+    from botocore.exceptions import ClientError
+
+    client = get_ec2_client()
+    tracker = get_placement_tracker()
+    metrics = get_metrics()
+    fills = []
+    remaining = count
+    last_error = None
+    for pool in pools:
+        market_options = {}
+        if pool.market == "spot":
+            market_options["InstanceMarketOptions"] = {
+                "MarketType": "spot",
+                "SpotOptions": {
+                    "SpotInstanceType": "one-time",
+                    "InstanceInterruptionBehavior": "terminate",
+                },
+            }
+        for subnet_id in tracker.order(subnet_ids):
+            start = time.monotonic()
+            try:
+                with metrics.time("RunInstances"), start_span(
+                    "ec2.run_instances",
+                    {
+                        "instance_type": pool.instance_type,
+                        "market": pool.market,
+                        "subnet_id": subnet_id,
+                    },
+                ):
+                    response = client.run_instances(
+                        InstanceType=pool.instance_type,
+                        MaxCount=remaining,
+                        MinCount=1,
+                        SubnetId=subnet_id,
+                        TagSpecifications=[
+                            {
+                                "ResourceType": "instance",
+                                "Tags": tags
+                                + [
+                                    {
+                                        "Key": CAPACITY_POOL_TAG_KEY,
+                                        "Value": f"{pool.instance_type}/{pool.market}",
+                                    }
+                                ],
+                            }
+                        ],
+                        **market_options,
+                        **request,
+                    )
+            except ClientError as error:
+                code = error.response.get("Error", {}).get("Code")
+                if code not in CAPACITY_ERROR_CODES:
+                    raise
+                logger.debug(
+                    f"The {pool.instance_type} {pool.market} pool failed in {subnet_id}: {code}"
+                )
+                last_error = error
+                if code not in ZONAL_CAPACITY_ERROR_CODES:
+                    # An account limit won't be any different in another subnet.
+                    break
+                tracker.record_capacity_error(subnet_id)
+                continue
+            instance_ids = [
+                instance["InstanceId"] for instance in response["Instances"]
+            ]
+            tracker.record_launch(subnet_id, time.monotonic() - start)
+            if len(instance_ids) < remaining:
+                tracker.record_capacity_error(subnet_id)
+            logger.debug(f"Launched {instance_ids} in {subnet_id}")
+            metrics.increment("Launches", len(instance_ids))
+            metrics.set_dimension("InstanceType", pool.instance_type)
+            fills.append((pool, instance_ids))
+            remaining -= len(instance_ids)
+            if remaining <= 0:
+                break
+        if remaining <= 0:
+            break
+    if not fills and last_error:
+        raise last_error
+    return fills
+
+
+class PlacementTracker:
+    """
+    Remembers recent capacity errors and launch latencies for each subnet, and orders the subnets
+    by how well their availability zones have been doing.
+
+    Each subnet is in a single zone, so tracking subnets tracks zones. A subnet's cost is the moving
+    average of its RunInstances latency, plus a penalty for its recent capacity errors, which decays
+    over time. A subnet that hasn't launched anything yet costs nothing, so launches spread across
+    the zones until there's something to tell them apart. Subnets that cost the same keep their
+    configured order.
+
+    The tracker lives as long as the execution environment, so what one invocation learns is used
+    by the warm invocations after it.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._errors = {}
+
+    def _penalty(self, subnet_id, now):
+        penalty, recorded_at = self._errors.get(subnet_id, (0, now))
+        return penalty * 0.5 ** (
+            (now - recorded_at) / PLACEMENT_ERROR_HALF_LIFE_SECONDS
+        )
+
+    def record_capacity_error(self, subnet_id):
+        with self._lock:
+            now = self._clock()
+            self._errors[subnet_id] = (
+                self._penalty(subnet_id, now) + PLACEMENT_ERROR_PENALTY_SECONDS,
+                now,
+            )
+
+    def record_launch(self, subnet_id, latency):
+        with self._lock:
+            average = self._latencies.get(subnet_id, latency)
+            self._latencies[subnet_id] = average + PLACEMENT_LATENCY_WEIGHT * (
+                latency - average
+            )
+
+    def _cost(self, subnet_id, now):
+        return self._latencies.get(subnet_id, 0) + self._penalty(subnet_id, now)
+
+    def order(self, subnet_ids):
+        with self._lock:
+            now = self._clock()
+            return sorted(subnet_ids, key=lambda subnet_id: self._cost(subnet_id, now))
+
+
+_placement_tracker = None
+_placement_tracker_lock = threading.Lock()
+
+
+def get_placement_tracker():
+    global _placement_tracker
+    with _placement_tracker_lock:
+        if _placement_tracker is None:
+            _placement_tracker = PlacementTracker()
+        return _placement_tracker
+
+
+class LaunchProfiles:
+    """
+    The launch profiles, which route jobs to instance types, AMIs, volume sizes and subnets by
+    their `runs-on` labels.
+
+    A job is given the most specific profile whose labels are all in the job's labels, or the
+    default profile if there isn't one. Where profiles are equally specific, the first one
+    configured wins. Each distinct set of labels is only matched once, then the result is cached.
+    """
+
+    def __init__(self, default, profiles):
+        self.default = default
+        self.profiles = profiles
+        self._by_specificity = sorted(
+            profiles, key=lambda profile: len(profile.labels), reverse=True
+        )
+        self._matches = {}
+
+    def match(self, labels):
+        key = frozenset(labels)
+        profile = self._matches.get(key)
+        if profile is None:
+            profile = next(
+                (p for p in self._by_specificity if p.labels <= key), self.default
+            )
+            self._matches[key] = profile
+        return profile
+
+    @classmethod
+    def from_env(cls):
+        """
+        Loads the profiles from the JSON list in `LAUNCH_PROFILES`.
+
+        Each profile has a `name` and a list of `labels`, and can override the `ami_id`,
+        `volume_size` and `spot` settings of the default profile, which is defined by the other
+        variables. It can override the subnets with a `subnet_id`, or a list of `subnet_ids` to
+        spread its instances across. It can also override the instance type, with either an
+        `instance_type`, or an ordered list of `instance_types` to fall back through.
+        """
+        (
+            ami_id,
+            iam_instance_profile,
+            instance_type,
+            key_name,
+            security_group_id,
+            subnet_ids,
+        ) = validate_env_vars()
+        fallback_instance_types = [
+            fallback_instance_type.strip()
+            for fallback_instance_type in os.getenv(
+                "EC2_FALLBACK_INSTANCE_TYPES", ""
+            ).split(",")
+            if fallback_instance_type.strip()
+        ]
+        default = LaunchProfile(
+            name="default",
+            labels=frozenset(),
+            ami_id=ami_id,
+            instance_types=tuple([instance_type] + fallback_instance_types),
+            spot=os.getenv("EC2_USE_SPOT") == "true",
+            subnet_ids=subnet_ids,
+            volume_size=None,
+            iam_instance_profile=iam_instance_profile,
+            key_name=key_name,
+            security_group_id=security_group_id,
+        )
+        try:
+            profiles_json = json.loads(os.getenv("LAUNCH_PROFILES") or "[]")
+        except ValueError:
+            raise ConfigurationError("The LAUNCH_PROFILES variable must be valid JSON")
+        if not isinstance(profiles_json, list):
+            raise ConfigurationError("The LAUNCH_PROFILES variable must be a list")
+        profiles = []
+        names = set()
+        for profile_json in profiles_json:
+            name = profile_json.get("name")
+            labels = profile_json.get("labels")
+            if not name or name in names:
+                raise ConfigurationError(
+                    f"Each launch profile must have a unique name: {profile_json}"
+                )
+            if not labels or not isinstance(labels, list):
+                raise ConfigurationError(f"The {name} launch profile must have labels")
+            unknown = set(profile_json) - {
+                "name",
+                "labels",
+                "ami_id",
+                "instance_type",
+                "instance_types",
+                "spot",
+                "subnet_id",
+                "subnet_ids",
+                "volume_size",
+            }
+            if unknown:
+                raise ConfigurationError(
+                    f"The {name} launch profile has unknown settings: {sorted(unknown)}"
+                )
+            volume_size = profile_json.get("volume_size")
+            if volume_size is not None and (
+                not isinstance(volume_size, int) or volume_size <= 0
+            ):
+                raise ConfigurationError(
+                    f"The volume_size of the {name} launch profile must be a positive integer"
+                )
+            instance_types = default.instance_types
+            if "instance_type" in profile_json and "instance_types" in profile_json:
+                raise ConfigurationError(
+                    f"The {name} launch profile can't have both instance_type and instance_types"
+                )
+            if "instance_type" in profile_json:
+                instance_types = (profile_json["instance_type"],)
+            elif "instance_types" in profile_json:
+                instance_types = profile_json["instance_types"]
+                if not instance_types or not isinstance(instance_types, list):
+                    raise ConfigurationError(
+                        f"The instance_types of the {name} launch profile must be a list"
+                    )
+                instance_types = tuple(instance_types)
+            profile_subnet_ids = default.subnet_ids
+            if "subnet_id" in profile_json and "subnet_ids" in profile_json:
+                raise ConfigurationError(
+                    f"The {name} launch profile can't have both subnet_id and subnet_ids"
+                )
+            if "subnet_id" in profile_json:
+                profile_subnet_ids = (profile_json["subnet_id"],)
+            elif "subnet_ids" in profile_json:
+                profile_subnet_ids = profile_json["subnet_ids"]
+                if not profile_subnet_ids or not isinstance(profile_subnet_ids, list):
+                    raise ConfigurationError(
+                        f"The subnet_ids of the {name} launch profile must be a list"
+                    )
+                profile_subnet_ids = tuple(profile_subnet_ids)
+            spot = profile_json.get("spot", default.spot)
+            if not isinstance(spot, bool):
+                raise ConfigurationError(
+                    f"The spot setting of the {name} launch profile must be true or false"
+                )
+            names.add(name)
+            profiles.append(
+                default._replace(
+                    name=name,
+                    labels=frozenset(labels),
+                    ami_id=profile_json.get("ami_id", ami_id),
+                    instance_types=instance_types,
+                    spot=spot,
+                    subnet_ids=profile_subnet_ids,
+                    volume_size=volume_size,
+                )
+            )
+        return cls(default, profiles)
+
+
+_launch_profiles = None
+_launch_profiles_lock = threading.Lock()
+
+
+def get_launch_profiles():
+    """
+    Gets the launch profiles, which are loaded and validated once, then reused across warm
+    invocations.
+    """
+    global _launch_profiles
+    with _launch_profiles_lock:
+        if _launch_profiles is None:
+            _launch_profiles = LaunchProfiles.from_env()
+        return _launch_profiles
+
+
+def get_runner_labels(profile):
+    return tuple(DEFAULT_RUNNER_LABELS) + tuple(
+        sorted(profile.labels - set(DEFAULT_RUNNER_LABELS))
+    )
+
+
+def get_warm_pool_size():
+    """
+    Gets the number of instances to keep in the warm pool, from `WARM_POOL_SIZE`.
+
+    The pool is only used in persistent mode, because a JIT runner's configuration is generated for
+    a particular job, so it can't be prepared in advance.
+    """
+    size = get_int_env("WARM_POOL_SIZE", 0)
+    if get_runner_mode() == "jit":
+        return 0
+    return size
+
+
+def get_int_env(name, default):
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ConfigurationError(f"The {name} variable must be a number: {value}")
+
+
+def get_scale_down_policy():
+    """
+    Gets the policy for removing idle runners.
+
+    A runner whose job has completed is retained for `IDLE_RUNNER_TTL_SECONDS`, so a job that's
+    queued in the meantime can reuse it, along with its warm Cargo home. The sweeper then removes
+    it, but always leaves `MIN_IDLE_RUNNERS`, and doesn't remove any within
+    `SCALE_DOWN_COOLDOWN_SECONDS` of a job being given a runner. With the default TTL of 0, runners
+    aren't retained, and each one is removed as soon as its job completes. Runners are never
+    retained in JIT mode.
+    """
+    policy = ScaleDownPolicy(
+        min_idle_runners=get_int_env("MIN_IDLE_RUNNERS", 0),
+        idle_ttl_seconds=get_int_env("IDLE_RUNNER_TTL_SECONDS", 0),
+        cooldown_seconds=get_int_env("SCALE_DOWN_COOLDOWN_SECONDS", 0),
+    )
+    if get_runner_mode() == "jit":
+        return policy._replace(idle_ttl_seconds=0)
+    return policy
+
+
+def claim_idle_runners(count, labels=DEFAULT_RUNNER_LABELS):
+    """
+    Claims up to `count` idle runners with all the `labels`, for queued jobs with those labels, so
+    they can be reused rather than launching new instances. Returns the IDs of their instances.
+
+    Github assigns a queued job to any idle runner with matching labels, so nothing needs to be
+    sent to the runner. The claim only stops other queued jobs from counting the same runner.
+
+    Only runners whose instance has been tagged with `IdleSince` by `retain_job_runner` are
+    claimed. A runner that has just registered is idle too, but it was launched for a job of its
+    own and will be assigned one shortly.
+    """
+    if count <= 0 or get_scale_down_policy().idle_ttl_seconds <= 0:
+        return []
+    try:
+        with get_metrics().time("IdleRunnerScan"):
+            runners = list_runners()
+            inventory = get_runner_inventory(get_ec2_client())
+    except Exception:
+        # The runner can still be launched, so this shouldn't fail the job.
+        logger.exception("Failed to list the runners to reuse")
+        return []
+    store = get_idempotency_store()
+    instance_ids = []
+    for runner in runners.idle():
+        if len(instance_ids) == count:
+            break
+        if runner.status != "online" or not set(labels) <= set(runner.labels):
+            continue
+        instance = inventory.find_by_runner_name(runner.name)
+        if not instance or not get_instance_tag(instance, IDLE_SINCE_TAG_KEY):
+            continue
+        if store.add(
+            f"idle-runner:{runner.name}",
+            {"status": "claimed"},
+            IDLE_RUNNER_CLAIM_SECONDS,
+        ):
+            instance_ids.append(instance["InstanceId"])
+    return instance_ids
+
+
+def record_scale_up():
+    """
+    Starts the cooldown, during which the sweeper doesn't remove any runners.
+    """
+    cooldown_seconds = get_scale_down_policy().cooldown_seconds
+    if cooldown_seconds > 0:
+        get_idempotency_store().put(
+            "scale-down-cooldown", {"status": "completed"}, cooldown_seconds
+        )
+
+
+def retain_job_runner(job):
+    """
+    Keeps the runner that ran the completed job, so it can be reused, and records when it became
+    idle. The sweeper removes it if it's still idle when its TTL expires.
+
+    If the job was cancelled before a runner picked it up, the instance launched for it is retained
+    instead.
+    """
+    client = get_ec2_client()
+    runner_name = job.get("runner_name")
+    if runner_name:
+        instance = find_runner_instance(client, RUNNER_NAME_TAG_KEY, runner_name)
+    else:
+        instance = find_runner_instance(client, JOB_ID_TAG_KEY, str(job["id"]))
+        if instance:
+            runner_name = get_instance_tag(instance, RUNNER_NAME_TAG_KEY)
+    if not instance:
+        logger.debug(f"No runner instance to retain for job {job['id']}")
+        return {"statusCode": 200, "body": "No runner instance to retain for the job"}
+    record_job_instance_type(job, instance)
+    instance_id = instance["InstanceId"]
+    client.create_tags(
+        Resources=[instance_id],
+        Tags=[{"Key": IDLE_SINCE_TAG_KEY, "Value": str(int(time.time()))}],
+    )
+    get_idempotency_store().delete(f"idle-runner:{runner_name}")
+    logger.debug(f"Retained {instance_id} with idle runner {runner_name}")
+    return {"statusCode": 200, "RetainedInstanceIds": [instance_id]}
+
+
+@instrumented
+def sweep_idle_runners(event, context):
+    """
+    The handler that removes idle runners whose TTL has expired, and terminates their instances.
+
+    The runners that have been idle longest are removed first, down to the minimum idle count.
+    Runners that have been claimed for queued jobs, and instances in the warm pool, are left alone.
+
+    When idle runners aren't retained, the only runners left for the sweeper are those whose
+    removal was deferred when their job completed, because the Github rate limit was running low.
+    They're removed together, in one batch, once the limit allows.
+
+    In JIT mode, runners are never retained, and the sweeper reclaims the JIT runners that won't
+    run a job instead.
+    """
+    policy = get_scale_down_policy()
+    if not github_rate_limit.allows_cleanup():
+        logger.debug(
+            "The Github rate limit is running low, so no runners will be removed"
+        )
+        return {"statusCode": 202, "body": "The Github rate limit is running low"}
+    if get_runner_mode() == "jit":
+        return sweep_jit_runners(Deadline(context))
+    store = get_idempotency_store()
+    if store.get("scale-down-cooldown"):
+        logger.debug("Runners were added recently, so none will be removed")
+        return {"statusCode": 200, "body": "Scale down is cooling down"}
+
+    deadline = Deadline(context)
+    client = get_ec2_client()
+    inventory = get_runner_inventory(client)
+    if policy.idle_ttl_seconds <= 0 and not any(
+        get_instance_tag(instance, IDLE_SINCE_TAG_KEY)
+        for instance in inventory.instances
+    ):
+        return {"statusCode": 200, "body": "There are no idle runners to remove"}
+    idle = []
+    for runner in list_runners().idle():
+        if runner.status != "online":
+            continue
+        instance = inventory.find_by_runner_name(runner.name)
+        if not instance or get_instance_tag(instance, WARM_POOL_TAG_KEY):
+            continue
+        if store.get(f"idle-runner:{runner.name}"):
+            continue
+        idle_since = get_instance_tag(instance, IDLE_SINCE_TAG_KEY)
+        if idle_since:
+            idle_since = float(idle_since)
+        elif policy.idle_ttl_seconds > 0:
+            idle_since = instance["LaunchTime"].timestamp()
+        else:
+            continue
+        idle.append((idle_since, runner, instance))
+    idle.sort(key=lambda entry: entry[0])
+
+    now = time.time()
+    removable = max(0, len(idle) - policy.min_idle_runners)
+    expired = [
+        (runner, instance)
+        for (idle_since, runner, instance) in idle
+        if now - idle_since > policy.idle_ttl_seconds
+    ][:removable]
+    logger.debug(f"Will remove expired idle runners {[r.name for r, _ in expired]}")
+    results = remove_runners([runner.id for (runner, _) in expired], deadline)
+    instance_ids = [
+        instance["InstanceId"]
+        for (runner, instance) in expired
+        if runner.id in results["removed"]
+    ]
+    if instance_ids:
+        logger.debug(f"Will terminate instances with IDs {instance_ids}")
+        client.terminate_instances(InstanceIds=instance_ids)
+    return {
+        "statusCode": 202 if results["deferred"] else 200,
+        "TerminatedInstanceIds": instance_ids,
+        "RemovedRunnerIds": results["removed"],
+        "FailedRunnerIds": results["failed"],
+        "DeferredRunnerIds": results["deferred"],
+    }
+
+
+def sweep_jit_runners(deadline):
+    """
+    Removes the JIT runners that won't run a job, and terminates their instances.
+
+    A JIT runner can be given any queued job with its labels, so if its own job is cancelled before
+    it's picked up, or goes to another runner, it may never run one. It then stays registered, and
+    its instance keeps running. An instance whose job was cancelled is tagged with `IdleSince` by
+    `release_jit_runner`, and is reclaimed straight away. Any other instance is reclaimed once it's
+    been running for `JIT_RUNNER_TTL_SECONDS` without its runner being busy, which also covers a
+    `completed` event that was lost. A busy runner is never touched.
+    """
+    ttl_seconds = get_int_env("JIT_RUNNER_TTL_SECONDS", DEFAULT_JIT_RUNNER_TTL_SECONDS)
+    client = get_ec2_client()
+    inventory = get_runner_inventory(client)
+    if not inventory.instances:
+        return {"statusCode": 200, "body": "There are no JIT runners to reclaim"}
+    runners = list_runners().by_name
+    now = time.time()
+    unused = []
+    for instance in inventory.instances:
+        runner_name = get_instance_tag(instance, RUNNER_NAME_TAG_KEY)
+        # An instance is only tagged with its runner's name once it's been launched.
+        if not runner_name:
+            continue
+        runner = runners.get(runner_name)
+        if runner and runner.busy:
+            continue
+        if not get_instance_tag(instance, IDLE_SINCE_TAG_KEY) and (
+            now - instance["LaunchTime"].timestamp() <= ttl_seconds
+        ):
+            continue
+        unused.append((runner, instance))
+    logger.debug(
+        f"Will reclaim unused JIT runner instances {[i['InstanceId'] for _, i in unused]}"
+    )
+    results = remove_runners([runner.id for (runner, _) in unused if runner], deadline)
+    # An instance whose runner isn't registered has nothing to remove first.
+    instance_ids = [
+        instance["InstanceId"]
+        for (runner, instance) in unused
+        if not runner or runner.id in results["removed"]
+    ]
+    if instance_ids:
+        logger.debug(f"Will terminate instances with IDs {instance_ids}")
+        client.terminate_instances(InstanceIds=instance_ids)
+    return {
+        "statusCode": 202 if results["deferred"] else 200,
+        "TerminatedInstanceIds": instance_ids,
+        "RemovedRunnerIds": results["removed"],
+        "FailedRunnerIds": results["failed"],
+        "DeferredRunnerIds": results["deferred"],
+    }
+
+
+def find_warm_pool_instances(client, states):
+    response = client.describe_instances(
+        Filters=[
+            {"Name": f"tag:{RUNNER_TAG_KEY}", "Values": ["true"]},
+            {"Name": f"tag:{WARM_POOL_TAG_KEY}", "Values": ["true"]},
+            {"Name": "instance-state-name", "Values": states},
+        ]
+    )
+    return [
+        instance
+        for reservation in response["Reservations"]
+        for instance in reservation["Instances"]
+    ]
+
+
+def take_warm_instances(count):
+    """
+    Takes up to `count` stopped instances from the warm pool and starts them.
+
+    Their runners are already registered, so they come online as soon as the instances have booted.
+    Each instance is claimed in the idempotency store first, so two workers can't take the same
+    one. The pool is then refilled asynchronously.
+    """
+    if count <= 0 or get_warm_pool_size() <= 0:
+        return []
+    client = get_ec2_client()
+    store = get_idempotency_store()
+    instance_ids = []
+    for instance in find_warm_pool_instances(client, ["stopped"]):
+        if len(instance_ids) == count:
+            break
+        instance_id = instance["InstanceId"]
+        if store.add(
+            f"warm-pool:{instance_id}", {"status": "taken"}, IDEMPOTENCY_TTL_SECONDS
+        ):
+            instance_ids.append(instance_id)
+    if not instance_ids:
+        logger.debug("The warm pool is empty")
+        return []
+    try:
+        client.delete_tags(Resources=instance_ids, Tags=[{"Key": WARM_POOL_TAG_KEY}])
+        client.start_instances(InstanceIds=instance_ids)
+    except Exception:
+        # Starting a stopped instance can fail if EC2 is short on capacity. The instances are
+        # returned to the pool, and the caller launches new ones instead.
+        logger.exception(f"Failed to start warm pool instances {instance_ids}")
+        client.create_tags(
+            Resources=instance_ids, Tags=[{"Key": WARM_POOL_TAG_KEY, "Value": "true"}]
+        )
+        release_event([f"warm-pool:{instance_id}" for instance_id in instance_ids])
+        return []
+    request_warm_pool_refill()
+    return instance_ids
+
+
+def request_warm_pool_refill():
+    """
+    Invokes the refill function asynchronously, so the pool is topped up without delaying the job
+    that took an instance. The scheduled refill covers a failure here.
+    """
+    function_name = os.getenv("WARM_POOL_REFILL_FUNCTION")
+    if not function_name:
+        return
+    try:
+        get_aws_client("lambda").invoke(
+            FunctionName=function_name, InvocationType="Event"
+        )
+    except Exception:
+        logger.exception("Failed to request a refill of the warm pool")
+
+
+@instrumented
+def refill_warm_pool(event, context):
+    """
+    The handler that keeps the warm pool at its configured size.
+
+    Instances that have been in the pool too long are replaced, because Github removes runners that
+    haven't connected for 14 days. New instances initialise, then stop themselves, at which point
+    they're available to be taken.
+    """
+    size = get_warm_pool_size()
+    store = get_idempotency_store()
+    if not store.add(
+        "warm-pool-refill", {"status": "in_progress"}, WARM_POOL_REFILL_LOCK_SECONDS
+    ):
+        logger.debug("Another refill of the warm pool is in progress")
+        return {"statusCode": 202, "body": "A refill is already in progress"}
+    try:
+        client = get_ec2_client()
+        instances = find_warm_pool_instances(
+            client, ["pending", "running", "stopping", "stopped"]
+        )
+        now = time.time()
+        expired = [
+            instance
+            for instance in instances
+            if instance["State"]["Name"] == "stopped"
+            and now - instance["LaunchTime"].timestamp() > WARM_POOL_MAX_AGE_SECONDS
+        ]
+        expired_instance_ids = [instance["InstanceId"] for instance in expired]
+        if expired_instance_ids:
+            remove_warm_pool_instances(client, expired)
+        launched_instance_ids = []
+        shortfall = size - (len(instances) - len(expired))
+        if shortfall > 0:
+            registration_token = get_registration_token()
+            user_data = get_user_data_script(
+                registration_token, script=WARM_POOL_USER_DATA_SCRIPT
+            )
+            launched_instance_ids = launch_instances(
+                shortfall,
+                user_data=user_data,
+                tags=[{"Key": WARM_POOL_TAG_KEY, "Value": "true"}],
+                # A one-time spot instance can't be stopped, so the pool is always on demand.
+                allow_spot=False,
+                InstanceInitiatedShutdownBehavior="stop",
+            )
+            for instance_id in launched_instance_ids:
+                tag_runner_instance(
+                    instance_id, get_persistent_runner_name(instance_id)
+                )
+            logger.debug(f"Launched {launched_instance_ids} into the warm pool")
+    finally:
+        store.delete("warm-pool-refill")
+    return {
+        "statusCode": 200,
+        "LaunchedInstanceIds": launched_instance_ids,
+        "ExpiredInstanceIds": expired_instance_ids,
+    }
+
+
+def remove_warm_pool_instances(client, instances):
+    """
+    Removes the runners for the warm pool instances, then terminates the instances.
+    """
+    runners = list_runners()
+    for instance in instances:
+        runner = runners.by_name.get(get_instance_tag(instance, RUNNER_NAME_TAG_KEY))
+        if runner:
+            remove_runner(runner.id)
+    instance_ids = [instance["InstanceId"] for instance in instances]
+    if instance_ids:
+        logger.debug(f"Will terminate expired warm pool instances {instance_ids}")
+        client.terminate_instances(InstanceIds=instance_ids)
+
+
+def validate_env_vars():
+    ami_id = os.getenv("AMI_ID")
+    if not ami_id:
+        raise ConfigurationError("The AMI_ID variable must be set")
+    iam_instance_profile = os.getenv("EC2_IAM_INSTANCE_PROFILE")
+    if not iam_instance_profile:
+        raise ConfigurationError("The EC2_IAM_INSTANCE_PROFILE variable must be set")
+    instance_type = os.getenv("EC2_INSTANCE_TYPE")
+    if not instance_type:
+        raise ConfigurationError("The EC2_INSTANCE_TYPE variable must be set")
+    key_name = os.getenv("EC2_KEY_NAME")
+    if not key_name:
+        raise ConfigurationError("The EC2_KEY_NAME variable must be set")
+    security_group_id = os.getenv("EC2_SECURITY_GROUP_ID")
+    if not security_group_id:
+        raise ConfigurationError("The EC2_SECURITY_GROUP_ID variable must be set")
+    # A single EC2_VPC_SUBNET_ID is still accepted, for deployments that predate the list.
+    subnet_ids = tuple(
+        subnet_id.strip()
+        for subnet_id in (
+            os.getenv("EC2_VPC_SUBNET_IDS") or os.getenv("EC2_VPC_SUBNET_ID", "")
+        ).split(",")
+        if subnet_id.strip()
+    )
+    if not subnet_ids:
+        raise ConfigurationError("The EC2_VPC_SUBNET_IDS variable must be set")
+    return (
+        ami_id,
+        iam_instance_profile,
+        instance_type,
+        key_name,
+        security_group_id,
+        subnet_ids,
+    )
+
+
+class SqsWebhookQueue:
+    """
+    Puts webhook payloads on an SQS queue, from which they're delivered in batches to the
+    `process_webhooks` handler.
+
+    The Github delivery ID is sent as a message attribute.
+    """
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+
+    def put(self, body, delivery_id=None):
+        attributes = {}
+        if delivery_id:
+            attributes["DeliveryId"] = {
+                "DataType": "String",
+                "StringValue": delivery_id,
+            }
+        get_aws_client("sqs").send_message(
+            QueueUrl=self.queue_url, MessageBody=body, MessageAttributes=attributes
+        )
+
+
+class InMemoryWebhookQueue:
+    """
+    A stand-in for the SQS queue, for tests and for running the handlers locally.
+
+    The messages are drained as an event with the same shape as one delivered to a Lambda by SQS,
+    so it can be passed directly to the `process_webhooks` handler.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages = deque()
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, body, delivery_id=None):
+        with self._lock:
+            self._next_id += 1
+            record = {"messageId": str(self._next_id), "body": body}
+            if delivery_id:
+                record["messageAttributes"] = {
+                    "DeliveryId": {"dataType": "String", "stringValue": delivery_id}
+                }
+            self._messages.append(record)
+
+    def drain(self, max_messages=10):
+        with self._lock:
+            records = []
+            while self._messages and len(records) < max_messages:
+                records.append(self._messages.popleft())
+            return {"Records": records}
+
+
+_webhook_queue = None
+_webhook_queue_lock = threading.Lock()
+
+
+def get_webhook_queue():
+    """
+    Gets the queue selected by `WEBHOOK_QUEUE_BACKEND`, which is either `sqs` or `memory`.
+    """
+    global _webhook_queue
+    with _webhook_queue_lock:
+        if _webhook_queue is None:
+            backend = os.getenv("WEBHOOK_QUEUE_BACKEND", "sqs")
+            if backend == "sqs":
+                queue_url = os.getenv("WEBHOOK_QUEUE_URL")
+                if not queue_url:
+                    raise ConfigurationError(
+                        "The WEBHOOK_QUEUE_URL variable must be set"
+                    )
+                _webhook_queue = SqsWebhookQueue(queue_url)
+            elif backend == "memory":
+                _webhook_queue = InMemoryWebhookQueue()
+            else:
+                raise ConfigurationError(
+                    f"The WEBHOOK_QUEUE_BACKEND variable has an unsupported value: {backend}"
+                )
+        return _webhook_queue
+
+
+class InMemoryIdempotencyStore:
+    """
+    Keeps the records for processed events in memory, for tests and for running the handlers
+    locally.
+
+    Each record is a dictionary with a `status`, which is `in_progress` or `completed`, and for a
+    completed event, the `result` of processing it.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._records = {}
+
+    def _get_live(self, key):
+        entry = self._records.get(key)
+        if entry and entry[1] > self._clock():
+            return entry[0]
+        return None
+
+    def add(self, key, record, ttl):
+        """
+        Stores the record, unless there's already an unexpired record for the key. Returns whether
+        the record was stored.
+        """
+        with self._lock:
+            if self._get_live(key) is not None:
+                return False
+            self._records[key] = (dict(record), self._clock() + ttl)
+            return True
+
+    def put(self, key, record, ttl):
+        with self._lock:
+            self._records[key] = (dict(record), self._clock() + ttl)
+
+    def get(self, key):
+        with self._lock:
+            record = self._get_live(key)
+            return dict(record) if record is not None else None
+
+    def delete(self, key):
+        with self._lock:
+            self._records.pop(key, None)
+
+
+class SqliteIdempotencyStore:
+    """
+    Keeps the records for processed events in a SQLite database, for running the handlers locally
+    with records that survive a restart.
+    """
+
+    def __init__(self, path, clock=time.time):
+        import sqlite3
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency "
+                "(key TEXT PRIMARY KEY, record TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def add(self, key, record, ttl):
+        now = self._clock()
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO idempotency (key, record, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET record = excluded.record, "
+                "expires_at = excluded.expires_at WHERE idempotency.expires_at <= ?",
+                (key, json.dumps(record), now + ttl, now),
+            )
+            return cursor.rowcount == 1
+
+    def put(self, key, record, ttl):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO idempotency (key, record, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(record), self._clock() + ttl),
+            )
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT record FROM idempotency WHERE key = ? AND expires_at > ?",
+                (key, self._clock()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, key):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+
+class DynamoDbIdempotencyStore:
+    """
+    Keeps the records for processed events in a DynamoDB table, so they're shared by every
+    execution environment.
+
+    A record is only added with a conditional write, so when two workers receive the same event at
+    the same time, only one of them can claim it. The table's TTL is set on the `ExpiresAt`
+    attribute, but DynamoDB deletes expired items some time after they expire, so the expiry is
+    also checked here.
+    """
+
+    def __init__(self, table_name, clock=time.time):
+        self.table_name = table_name
+        self._clock = clock
+
+    def _item(self, key, record, ttl):
+        return {
+            "IdempotencyKey": {"S": key},
+            "Record": {"S": json.dumps(record)},
+            "ExpiresAt": {"N": str(int(self._clock() + ttl))},
+        }
+
+    def add(self, key, record, ttl):
+        client = get_aws_client("dynamodb")
+        try:
+            client.put_item(
+                TableName=self.table_name,
+                Item=self._item(key, record, ttl),
+                ConditionExpression="attribute_not_exists(IdempotencyKey) OR ExpiresAt <= :now",
+                ExpressionAttributeValues={":now": {"N": str(int(self._clock()))}},
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def put(self, key, record, ttl):
+        get_aws_client("dynamodb").put_item(
+            TableName=self.table_name, Item=self._item(key, record, ttl)
+        )
+
+    def get(self, key):
+        response = get_aws_client("dynamodb").get_item(
+            TableName=self.table_name,
+            Key={"IdempotencyKey": {"S": key}},
+            ConsistentRead=True,
+        )
+        item = response.get("Item")
+        if not item or int(item["ExpiresAt"]["N"]) <= self._clock():
+            return None
+        return json.loads(item["Record"]["S"])
+
+    def delete(self, key):
+        get_aws_client("dynamodb").delete_item(
+            TableName=self.table_name, Key={"IdempotencyKey": {"S": key}}
+        )
+
 
-mkdir /mnt/data/tmp
-chmod 0777 /mnt/data/tmp
+_idempotency_store = None
+_idempotency_store_lock = threading.Lock()
 
-mkdir /mnt/data/runner
-chown ubuntu:ubuntu /mnt/data/runner
 
-mkdir /mnt/data/cargo
-chown ubuntu:ubuntu /mnt/data/cargo
-echo "CARGO_HOME=/mnt/data/cargo" >> /etc/environment
+def get_idempotency_store():
+    """
+    Gets the store selected by `IDEMPOTENCY_BACKEND`, which is `dynamodb`, `sqlite` or `memory`.
+    """
+    global _idempotency_store
+    with _idempotency_store_lock:
+        if _idempotency_store is None:
+            backend = os.getenv("IDEMPOTENCY_BACKEND", "memory")
+            if backend == "dynamodb":
+                table_name = os.getenv("IDEMPOTENCY_TABLE_NAME")
+                if not table_name:
+                    raise ConfigurationError(
+                        "The IDEMPOTENCY_TABLE_NAME variable must be set"
+                    )
+                _idempotency_store = DynamoDbIdempotencyStore(table_name)
+            elif backend == "sqlite":
+                _idempotency_store = SqliteIdempotencyStore(
+                    os.getenv("IDEMPOTENCY_SQLITE_PATH", "/tmp/idempotency.db")
+                )
+            elif backend == "memory":
+                _idempotency_store = InMemoryIdempotencyStore()
+            else:
+                raise ConfigurationError(
+                    f"The IDEMPOTENCY_BACKEND variable has an unsupported value: {backend}"
+                )
+        return _idempotency_store
 
-su ubuntu <<'EOF'
-cd /home/ubuntu
-REGISTRATION_TOKEN="__REGISTRATION_TOKEN__"
-RUNNER_BASE_URL="https://github.com/actions/runner/releases/download"
-RUNNER_VERSION="v2.317.0"
-RUNNER_ARCHIVE_NAME="actions-runner-linux-x64-2.317.0.tar.gz"
-SAFE_NETWORK_REPO_URL="https://github.com/maidsafe/safe_network"
 
-cd /mnt/data/runner
-mkdir actions-runner && cd actions-runner
-curl -O -L ${RUNNER_BASE_URL}/${RUNNER_VERSION}/${RUNNER_ARCHIVE_NAME}
+class InMemoryJobTimingStore:
+    """
+    Keeps the job timings in memory, for tests and for running the handlers locally.
+    """
 
-tar xvf ${RUNNER_ARCHIVE_NAME}
-./config.sh --unattended \
-  --url "${SAFE_NETWORK_REPO_URL}" --token "${REGISTRATION_TOKEN}" --labels self-hosted
-EOF
-(
-    cd /mnt/data/runner/actions-runner
-    ./svc.sh install ubuntu
-    ./svc.sh start
-)
-"""
-SIGNATURE_HEADER = "X-Hub-Signature-256"
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._timings = {}
 
+    def record(self, job_id, fields, ttl=JOB_TIMINGS_TTL_SECONDS):
+        """
+        Sets the fields of the job's timing, leaving any others as they were.
+        """
+        with self._lock:
+            timing, _ = self._timings.get(
+                job_id, (JobTiming(job_id, (), None, None, None, None), None)
+            )
+            self._timings[job_id] = (timing._replace(**fields), self._clock() + ttl)
 
-class ConfigurationError(Exception):
-    pass
+    def get(self, job_id):
+        with self._lock:
+            entry = self._timings.get(job_id)
+            if entry and entry[1] > self._clock():
+                return entry[0]
+            return None
 
+    def list(self, since):
+        with self._lock:
+            now = self._clock()
+            return [
+                timing
+                for (timing, expires_at) in self._timings.values()
+                if expires_at > now and (timing.queued_at or 0) >= since
+            ]
 
-def get_installed_app_token():
+
+class SqliteJobTimingStore:
+    """
+    Keeps the job timings in a SQLite database, one compact row per job, for running the handlers
+    locally with timings that survive a restart.
     """
-    Gets a token for the installed Github App, which can then be used for the APIs that require it,
-    such as requesting a registration token for a runner.
 
-    The Github documentation outlines the full process:
-    https://docs.github.com/en/developers/apps/building-github-apps/authenticating-with-github-apps#authenticating-as-a-github-app
+    def __init__(self, path, clock=time.time):
+        import sqlite3
 
-    The summary is:
-    * Use the private key registered with the runner app installed on the organisation to generate
-      a JWT. Github requires sending an issue time and an expiry time for the token. The minus 60
-      seconds is for "clock drift."
-    * Authenticate with that token to get the app installation ID.
-    * Make another request with the installation ID and the same JWT to get an access token.
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS job_timings (job_id INTEGER PRIMARY KEY, "
+                "labels TEXT, instance_type TEXT, queued_at REAL, started_at REAL, "
+                "completed_at REAL, expires_at REAL NOT NULL)"
+            )
 
-    The private key is a PEM, but it's assigned to an environment variable as a base64-encoded
-    string without any newline characters, to avoid any issues with that. We can't read it from a
-    file because this code is executing in the context of a Lambda function.
+    def record(self, job_id, fields, ttl=JOB_TIMINGS_TTL_SECONDS):
+        fields = dict(fields)
+        if "labels" in fields:
+            fields["labels"] = ",".join(fields["labels"])
+        columns = ["job_id"] + list(fields) + ["expires_at"]
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns[1:])
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT INTO job_timings ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' for _ in columns)}) "
+                f"ON CONFLICT (job_id) DO UPDATE SET {updates}",
+                [job_id] + list(fields.values()) + [self._clock() + ttl],
+            )
+
+    def _select(self, condition, parameters):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT job_id, labels, instance_type, queued_at, started_at, completed_at "
+                f"FROM job_timings WHERE expires_at > ? AND {condition}",
+                [self._clock()] + parameters,
+            ).fetchall()
+        return [
+            JobTiming(row[0], tuple(row[1].split(",")) if row[1] else (), *row[2:])
+            for row in rows
+        ]
+
+    def get(self, job_id):
+        timings = self._select("job_id = ?", [job_id])
+        return timings[0] if timings else None
+
+    def list(self, since):
+        return self._select("queued_at >= ?", [since])
+
+
+class DynamoDbJobTimingStore:
+    """
+    Keeps the job timings in a DynamoDB table, one item per job, so the events for a job can be
+    handled by any execution environment. The table's TTL is set on the `ExpiresAt` attribute.
     """
-    app_id = os.getenv("GITHUB_APP_ID")
-    if not app_id:
-        raise ConfigurationError("The GITHUB_APP_ID variable must be set")
-    private_key_base64 = os.getenv("GITHUB_APP_PRIVATE_KEY_BASE64")
-    if not private_key_base64:
-        raise ConfigurationError(
-            "The GITHUB_APP_PRIVATE_KEY_BASE64 variable must be set"
-        )
-    private_key = base64.b64decode(private_key_base64).decode("ascii")
 
-    iat = int(time.time()) - 60
-    exp = int(time.time()) + (10 * 60)
-    payload = {"iat": iat, "exp": exp, "iss": int(app_id)}
-    encoded_jwt = jwt.encode(payload, private_key, algorithm="RS256")
-    headers = {
-        "Authorization": f"Bearer {encoded_jwt}",
-        "Accept": "application/vnd.github+json",
+    ATTRIBUTES = {
+        "labels": "Labels",
+        "instance_type": "InstanceType",
+        "queued_at": "QueuedAt",
+        "started_at": "StartedAt",
+        "completed_at": "CompletedAt",
     }
-    response = requests.get("https://api.github.com/app/installations", headers=headers)
-    if response.status_code != 200:
-        logger.debug("Received unexpected response when requesting installation ID")
-        logger.debug(f"status_code: {response.status_code}")
-        logger.debug(f"text: {response.text}")
-        raise ConfigurationError("Unexpected response indicates configuration issue")
-    json = response.json()
-    installation_id = json[0]["id"]
 
-    response = requests.post(
-        f"https://api.github.com/app/installations/{installation_id}/access_tokens",
-        headers=headers,
-    )
-    json = response.json()
-    token = json["token"]
-    return token
+    def __init__(self, table_name, clock=time.time):
+        self.table_name = table_name
+        self._clock = clock
 
+    def record(self, job_id, fields, ttl=JOB_TIMINGS_TTL_SECONDS):
+        values = {":expires_at": {"N": str(int(self._clock() + ttl))}}
+        updates = ["ExpiresAt = :expires_at"]
+        for field, value in fields.items():
+            attribute = self.ATTRIBUTES[field]
+            if field == "labels":
+                values[f":{field}"] = {"S": ",".join(value)}
+            elif field == "instance_type":
+                values[f":{field}"] = {"S": value}
+            else:
+                values[f":{field}"] = {"N": str(value)}
+            updates.append(f"{attribute} = :{field}")
+        get_aws_client("dynamodb").update_item(
+            TableName=self.table_name,
+            Key={"JobId": {"N": str(job_id)}},
+            UpdateExpression="SET " + ", ".join(updates),
+            ExpressionAttributeValues=values,
+        )
 
-def get_registration_token():
-    token = get_installed_app_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/vnd.github+json",
+    def _to_timing(self, item):
+        def number(attribute):
+            return float(item[attribute]["N"]) if attribute in item else None
+
+        labels = item.get("Labels", {}).get("S")
+        return JobTiming(
+            job_id=int(item["JobId"]["N"]),
+            labels=tuple(labels.split(",")) if labels else (),
+            instance_type=item.get("InstanceType", {}).get("S"),
+            queued_at=number("QueuedAt"),
+            started_at=number("StartedAt"),
+            completed_at=number("CompletedAt"),
+        )
+
+    def get(self, job_id):
+        response = get_aws_client("dynamodb").get_item(
+            TableName=self.table_name,
+            Key={"JobId": {"N": str(job_id)}},
+            ConsistentRead=True,
+        )
+        item = response.get("Item")
+        return self._to_timing(item) if item else None
+
+    def list(self, since):
+        paginator = get_aws_client("dynamodb").get_paginator("scan")
+        pages = paginator.paginate(
+            TableName=self.table_name,
+            FilterExpression="QueuedAt >= :since AND ExpiresAt > :now",
+            ExpressionAttributeValues={
+                ":since": {"N": str(since)},
+                ":now": {"N": str(int(self._clock()))},
+            },
+        )
+        return [self._to_timing(item) for page in pages for item in page["Items"]]
+
+
+_job_timing_store = None
+_job_timing_store_lock = threading.Lock()
+
+
+def get_job_timing_store():
+    """
+    Gets the store selected by `JOB_TIMINGS_BACKEND`, which is `dynamodb`, `sqlite` or `memory`.
+    """
+    global _job_timing_store
+    with _job_timing_store_lock:
+        if _job_timing_store is None:
+            backend = os.getenv("JOB_TIMINGS_BACKEND", "memory")
+            if backend == "dynamodb":
+                table_name = os.getenv("JOB_TIMINGS_TABLE_NAME")
+                if not table_name:
+                    raise ConfigurationError(
+                        "The JOB_TIMINGS_TABLE_NAME variable must be set"
+                    )
+                _job_timing_store = DynamoDbJobTimingStore(table_name)
+            elif backend == "sqlite":
+                _job_timing_store = SqliteJobTimingStore(
+                    os.getenv("JOB_TIMINGS_SQLITE_PATH", "/tmp/job_timings.db")
+                )
+            elif backend == "memory":
+                _job_timing_store = InMemoryJobTimingStore()
+            else:
+                raise ConfigurationError(
+                    f"The JOB_TIMINGS_BACKEND variable has an unsupported value: {backend}"
+                )
+        return _job_timing_store
+
+
+def record_job_timing(workflow_job):
+    """
+    Records the time of the job's latest event.
+
+    The job is timed from Github's timestamps, not from when the event was received. Each event
+    also carries the timestamps of the earlier ones, so a missed event is filled in. A `queued`
+    event's `started_at` isn't meaningful, so only the timestamps up to the current action are
+    taken. A failure is logged rather than raised, because the timings mustn't hold up a job.
+    """
+    fields_by_action = {
+        "queued": [("queued_at", "created_at")],
+        "in_progress": [("queued_at", "created_at"), ("started_at", "started_at")],
+        "completed": [
+            ("queued_at", "created_at"),
+            ("started_at", "started_at"),
+            ("completed_at", "completed_at"),
+        ],
     }
-    response = requests.post(
-        "https://api.github.com/repos/maidsafe/safe_network/actions/runners/registration-token",
-        headers=headers,
-    )
-    json = response.json()
-    registration_token = json["token"]
-    return registration_token
+    action = workflow_job["action"]
+    job = workflow_job["workflow_job"]
+    if action not in fields_by_action:
+        return
+    fields = {"labels": tuple(job["labels"])}
+    for field, key in fields_by_action[action]:
+        if job.get(key):
+            fields[field] = parse_github_timestamp(job[key])
+    fields.setdefault(fields_by_action[action][-1][0], time.time())
+    try:
+        get_job_timing_store().record(job["id"], fields)
+    except Exception:
+        logger.exception(f"Failed to record the timing of job {job['id']}")
 
 
-def get_idle_runners():
-    token = get_installed_app_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/vnd.github+json",
+def record_job_instance_type(job, instance):
+    """
+    Records the type of the instance the job ran on, which is only known once it's completed and
+    its instance has been found.
+    """
+    instance_type = instance.get("InstanceType")
+    if not instance_type:
+        return
+    try:
+        get_job_timing_store().record(job["id"], {"instance_type": instance_type})
+    except Exception:
+        logger.exception(f"Failed to record the instance type of job {job['id']}")
+
+
+def get_queue_wait(timing):
+    if timing.queued_at is None or timing.started_at is None:
+        return None
+    return max(0, timing.started_at - timing.queued_at)
+
+
+def get_run_duration(timing):
+    if timing.started_at is None or timing.completed_at is None:
+        return None
+    return max(0, timing.completed_at - timing.started_at)
+
+
+def emit_job_timing_metrics(job_id):
+    """
+    Emits how long the completed job waited for a runner and how long it ran, as EMF metrics with
+    the job's labels and instance type as dimensions, so CloudWatch can chart their percentiles.
+    """
+    try:
+        timing = get_job_timing_store().get(job_id)
+    except Exception:
+        logger.exception(f"Failed to get the timing of job {job_id}")
+        return
+    if not timing:
+        return
+    values = {
+        "QueueWait": get_queue_wait(timing),
+        "RunDuration": get_run_duration(timing),
     }
-    response = requests.get(
-        "https://api.github.com/repos/maidsafe/safe_network/actions/runners",
-        headers=headers,
-    )
-    json = response.json()
-    return [(x["id"], x["name"]) for x in json["runners"] if x["busy"] == False]
+    values = {name: value for name, value in values.items() if value is not None}
+    if not values:
+        return
+    document = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Labels", "InstanceType"]],
+                    "Metrics": [{"Name": name, "Unit": "Seconds"} for name in values],
+                }
+            ],
+        },
+        "Labels": ",".join(timing.labels),
+        "InstanceType": timing.instance_type or "none",
+        "JobId": timing.job_id,
+    }
+    document.update(values)
+    try:
+        get_metrics_sink().emit(document)
+    except Exception:
+        logger.exception("Failed to emit the job timing metrics")
 
 
-def remove_runner(id):
-    # The `workflow_job` event may have been received very quickly.
-    # Therefore, sleep for a few seconds in case it takes some time to be marked as idle.
-    time.sleep(3)
-    token = get_installed_app_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/vnd.github+json",
+def get_percentiles(values, percentiles=JOB_TIMING_PERCENTILES):
+    """
+    Gets the nearest-rank percentiles of the values, or `None` if there aren't any.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        f"p{percentile}": ordered[max(0, -(-percentile * len(ordered) // 100) - 1)]
+        for percentile in percentiles
     }
-    response = requests.delete(
-        f"https://api.github.com/repos/maidsafe/safe_network/actions/runners/{id}",
-        headers=headers,
-    )
-    return response.status_code
 
 
-def get_user_data_script(registration_token):
-    # This is only really in its own function for testing purposes.
-    # You can 'spy' on it and check the return value.
-    user_data_script_with_token = USER_DATA_SCRIPT.replace(
-        "__REGISTRATION_TOKEN__", registration_token
-    )
-    return user_data_script_with_token
+def summarize_job_timings(timings):
+    """
+    Groups the jobs by their labels and instance type, and gets the percentiles of how long they
+    waited for a runner and how long they ran, in seconds. Jobs that haven't started yet count
+    towards the group, but not the percentiles.
+    """
+    groups = {}
+    for timing in timings:
+        key = (",".join(timing.labels), timing.instance_type or "unknown")
+        group = groups.setdefault(
+            key, {"jobs": 0, "queue_wait": [], "run_duration": []}
+        )
+        group["jobs"] += 1
+        queue_wait = get_queue_wait(timing)
+        if queue_wait is not None:
+            group["queue_wait"].append(queue_wait)
+        run_duration = get_run_duration(timing)
+        if run_duration is not None:
+            group["run_duration"].append(run_duration)
+    return [
+        {
+            "labels": labels,
+            "instance_type": instance_type,
+            "jobs": group["jobs"],
+            "queue_wait": get_percentiles(group["queue_wait"]),
+            "run_duration": get_percentiles(group["run_duration"]),
+        }
+        for (labels, instance_type), group in sorted(groups.items())
+    ]
 
 
-def validate_env_vars():
-    ami_id = os.getenv("AMI_ID")
-    if not ami_id:
-        raise ConfigurationError("The AMI_ID variable must be set")
-    iam_instance_profile = os.getenv("EC2_IAM_INSTANCE_PROFILE")
-    if not iam_instance_profile:
-        raise ConfigurationError("The EC2_IAM_INSTANCE_PROFILE variable must be set")
-    instance_type = os.getenv("EC2_INSTANCE_TYPE")
-    if not instance_type:
-        raise ConfigurationError("The EC2_INSTANCE_TYPE variable must be set")
-    key_name = os.getenv("EC2_KEY_NAME")
-    if not key_name:
-        raise ConfigurationError("The EC2_KEY_NAME variable must be set")
-    security_group_id = os.getenv("EC2_SECURITY_GROUP_ID")
-    if not security_group_id:
-        raise ConfigurationError("The EC2_SECURITY_GROUP_ID variable must be set")
-    subnet_id = os.getenv("EC2_VPC_SUBNET_ID")
-    if not subnet_id:
-        raise ConfigurationError("The EC2_VPC_SUBNET_ID variable must be set")
-    return (
-        ami_id,
-        iam_instance_profile,
-        instance_type,
-        key_name,
-        security_group_id,
-        subnet_id,
+def format_job_timing_report(rows):
+    def format_percentiles(percentiles):
+        if not percentiles:
+            return "-"
+        return "/".join(f"{value:.0f}" for value in percentiles.values())
+
+    header = ("LABELS", "INSTANCE TYPE", "JOBS", "WAIT P50/P95/P99", "RUN P50/P95/P99")
+    lines = [header] + [
+        (
+            row["labels"],
+            row["instance_type"],
+            str(row["jobs"]),
+            format_percentiles(row["queue_wait"]),
+            format_percentiles(row["run_duration"]),
+        )
+        for row in rows
+    ]
+    widths = [max(len(line[column]) for line in lines) for column in range(len(header))]
+    return "\n".join(
+        "  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+        for line in lines
     )
 
 
+def get_idempotency_keys(workflow_job, delivery_id=None):
+    """
+    Gets the keys an event is deduplicated on.
+
+    Only the events that can launch or terminate an instance are deduplicated. The delivery ID
+    catches a redelivery of the same webhook, and the job ID and action catch the same event being
+    sent in more than one delivery.
+    """
+    if workflow_job["action"] not in ("queued", "completed"):
+        return []
+    if "self-hosted" not in workflow_job["workflow_job"]["labels"]:
+        return []
+    keys = [f"job:{workflow_job['workflow_job']['id']}:{workflow_job['action']}"]
+    if delivery_id:
+        keys.insert(0, f"delivery:{delivery_id}")
+    return keys
+
+
+def claim_event(keys):
+    """
+    Claims the event for processing, by adding an in-progress record for each of its keys.
+
+    Returns `None` if the event was claimed. Otherwise, it's a duplicate, and the response to return
+    for it is the result of the original, or if the original is still being processed, a 202.
+    """
+    store = get_idempotency_store()
+    claimed = []
+    for key in keys:
+        if store.add(
+            key, {"status": "in_progress"}, IDEMPOTENCY_IN_PROGRESS_TTL_SECONDS
+        ):
+            claimed.append(key)
+            continue
+        release_event(claimed)
+        existing = store.get(key)
+        logger.debug(f"Event with key {key} is a duplicate")
+        get_metrics().increment("DuplicateDeliveries")
+        if existing and existing["status"] == "completed":
+            return existing["result"]
+        return dict(EVENT_IN_PROGRESS_RESPONSE)
+    return None
+
+
+def complete_event(keys, result):
+    store = get_idempotency_store()
+    for key in keys:
+        store.put(
+            key, {"status": "completed", "result": result}, IDEMPOTENCY_TTL_SECONDS
+        )
+
+
+def release_event(keys):
+    """
+    Removes the claim on an event that failed, so that a retry can process it.
+    """
+    store = get_idempotency_store()
+    for key in keys:
+        store.delete(key)
+
+
+def process_once(workflow_job, delivery_id, context):
+    """
+    Processes the event, unless it's a duplicate of one that's already been processed, in which
+    case the original result is returned without touching EC2.
+    """
+    keys = get_idempotency_keys(workflow_job, delivery_id)
+    duplicate_response = claim_event(keys)
+    if duplicate_response is not None:
+        return duplicate_response
+    try:
+        response = process_workflow_job(workflow_job, context)
+    except Exception:
+        release_event(keys)
+        raise
+    complete_event(keys, response)
+    return response
+
+
 def is_signature_valid(signature, payload):
     secret = os.getenv("GITHUB_APP_SECRET")
     if not secret:
@@ -219,7 +3629,10 @@ def is_signature_valid(signature, payload):
     return hmac.compare_digest(digest, signature)
 
 
-def manage_runners(event, context):
+def check_signature(event):
+    """
+    Returns an error response if the request isn't correctly signed, otherwise `None`.
+    """
     request_headers = event["headers"]
     if SIGNATURE_HEADER not in request_headers:
         logger.debug("The request did not contain the signature header")
@@ -228,12 +3641,326 @@ def manage_runners(event, context):
             "body": "The request did not contain the signature header",
         }
     signature = event["headers"][SIGNATURE_HEADER]
-    if not is_signature_valid(signature, event["body"]):
+    with get_metrics().time("SignatureCheck"):
+        valid = is_signature_valid(signature, event["body"])
+    if not valid:
         logger.debug("Signature received is not valid")
         return {"statusCode": 401, "body": "Signature received is not valid"}
+    return None
+
+
+@instrumented
+def receive_webhook(event, context):
+    """
+    The handler for the webhook endpoint, when events are processed asynchronously.
+
+    It only verifies the signature and puts the payload on the queue, so Github receives a response
+    well within its 10 second delivery timeout, no matter how long the Github and EC2 requests take
+    when the event is processed. Only `workflow_job` events are queued; any other event the app
+    receives, such as a `ping`, is acknowledged and dropped.
+    """
+    error_response = check_signature(event)
+    if error_response:
+        return error_response
+    event_type = event["headers"].get(EVENT_HEADER)
+    if event_type != "workflow_job":
+        logger.debug(f"A {event_type} event will not be processed")
+        return {
+            "statusCode": 200,
+            "body": "Only workflow_job events are processed",
+        }
+    delivery_id = event["headers"].get(DELIVERY_HEADER)
+    get_webhook_queue().put(event["body"], delivery_id)
+    logger.debug(f"Queued delivery {delivery_id}")
+    return {"statusCode": 202, "body": "The workflow_job has been queued"}
+
+
+def is_launch_request(workflow_job):
+    return (
+        workflow_job["action"] == "queued"
+        and "self-hosted" in workflow_job["workflow_job"]["labels"]
+    )
+
+
+def launch_instances_for_jobs(queued_jobs):
+    """
+    Launches an instance for each of the queued jobs, with a single RunInstances request for each
+    launch profile.
+
+    The `queued_jobs` are `(message_id, workflow_job)` pairs. Returns the mapping of job IDs to
+    instance IDs, along with the message IDs of any jobs that didn't get an instance, so they can be
+    retried.
+    """
+    if get_runner_mode() == "jit":
+        return launch_jit_instances_for_jobs(queued_jobs)
+    profiles = get_launch_profiles()
+    jobs_by_profile = {}
+    for message_id, workflow_job in queued_jobs:
+        profile = profiles.match(workflow_job["workflow_job"]["labels"])
+        jobs_by_profile.setdefault(profile, []).append((message_id, workflow_job))
+    launched = {}
+    unlaunched = []
+    for profile, profile_jobs in jobs_by_profile.items():
+        # The jobs share a launch request, so they share a trace, which carries all their IDs.
+        job_ids = [str(job["workflow_job"]["id"]) for (_, job) in profile_jobs]
+        try:
+            with start_span(
+                "launch_instances",
+                {"launch_profile": profile.name, "job.ids": ",".join(job_ids)},
+            ):
+                profile_launched, profile_unlaunched = launch_instances_for_profile(
+                    profile, profile_jobs, use_warm_pool=profile == profiles.default
+                )
+        except Exception:
+            logger.exception(f"Failed to give the {profile.name} jobs instances")
+            profile_launched = {}
+            profile_unlaunched = [message_id for (message_id, _) in profile_jobs]
+        launched.update(profile_launched)
+        unlaunched.extend(profile_unlaunched)
+    return (launched, unlaunched)
+
+
+def launch_instances_for_profile(profile, queued_jobs, use_warm_pool):
+    """
+    Gives each of the queued jobs, which all match the launch profile, an instance.
+
+    As many jobs as possible reuse idle runners, then as many as possible are given instances from
+    the warm pool, and only the rest are launched. The instances are assigned to the jobs in order.
+    """
+    labels = get_runner_labels(profile)
+    instance_ids = claim_idle_runners(len(queued_jobs), labels)
+    if instance_ids:
+        logger.debug(f"Reusing idle runners on {instance_ids}")
+    if use_warm_pool:
+        warm_instance_ids = take_warm_instances(len(queued_jobs) - len(instance_ids))
+        if warm_instance_ids:
+            logger.debug(f"Took {warm_instance_ids} from the warm pool")
+            instance_ids += warm_instance_ids
+    if len(instance_ids) < len(queued_jobs):
+        try:
+            instance_ids += launch_instances(
+                len(queued_jobs) - len(instance_ids), profile=profile
+            )
+        except Exception:
+            logger.exception(
+                f"Failed to launch {profile.name} instances for {len(queued_jobs)} jobs"
+            )
+    if instance_ids:
+        record_scale_up()
+    launched = {}
+    for (_, workflow_job), instance_id in zip(queued_jobs, instance_ids):
+        job_id = workflow_job["workflow_job"]["id"]
+        launched[job_id] = instance_id
+        logger.debug(f"Launched EC2 instance with ID {instance_id} for job {job_id}")
+        tag_runner_instance(
+            instance_id, get_persistent_runner_name(instance_id), workflow_job
+        )
+    unlaunched = [message_id for (message_id, _) in queued_jobs[len(instance_ids) :]]
+    if unlaunched:
+        logger.debug(f"{len(unlaunched)} jobs did not receive an instance")
+    return (launched, unlaunched)
+
+
+def launch_jit_instances_for_jobs(queued_jobs):
+    launched = {}
+    unlaunched = []
+    for message_id, workflow_job in queued_jobs:
+        job_id = workflow_job["workflow_job"]["id"]
+        try:
+            with start_span(
+                "workflow_job.queued", get_job_span_attributes(workflow_job)
+            ):
+                launched[job_id] = launch_jit_instance(workflow_job)
+        except Exception:
+            logger.exception(f"Failed to launch an instance for job {job_id}")
+            unlaunched.append(message_id)
+    return (launched, unlaunched)
+
+
+def get_delivery_id(record):
+    attribute = record.get("messageAttributes", {}).get("DeliveryId")
+    return attribute["stringValue"] if attribute else None
+
+
+@instrumented
+def process_webhooks(event, context):
+    """
+    The handler for a batch of webhook payloads received from the queue.
+
+    A burst of queued jobs, such as those from a matrix workflow, arrives in one batch, because the
+    event source waits for the batching window to fill. The instances for all of them are launched
+    with one request rather than one each, which avoids EC2 throttling. That's done first, because
+    it's the work that jobs are waiting on. The other events are then processed one at a time.
+
+    Any records that fail are reported as batch item failures, so only those are returned to the
+    queue to be retried. Duplicates of events that have already been processed are dropped. A
+    duplicate of an event that's still being processed is also returned to the queue, because the
+    original may yet fail. By the time it's redelivered, either the original has completed, or its
+    claim has expired.
+
+    Whatever happens during the launch, the claims on the queued jobs that didn't get an instance
+    are released, so they can be retried.
+    """
+    failures = []
+    queued_jobs = []
+    other_jobs = []
+    keys_by_message = {}
+    for record in event["Records"]:
+        try:
+            workflow_job = json.loads(record["body"])
+            launch_request = is_launch_request(workflow_job)
+        except (ValueError, KeyError, TypeError):
+            logger.exception(
+                f"Message {record['messageId']} is not a valid workflow_job payload"
+            )
+            failures.append(record["messageId"])
+            continue
+        if launch_request:
+            keys = get_idempotency_keys(workflow_job, get_delivery_id(record))
+            try:
+                duplicate_response = claim_event(keys)
+            except Exception:
+                logger.exception(f"Failed to claim message {record['messageId']}")
+                failures.append(record["messageId"])
+                continue
+            if duplicate_response == EVENT_IN_PROGRESS_RESPONSE:
+                logger.debug(
+                    f"Message {record['messageId']} is still being processed; will retry"
+                )
+                failures.append(record["messageId"])
+                continue
+            if duplicate_response is not None:
+                logger.debug(f"Skipped duplicate message {record['messageId']}")
+                continue
+            keys_by_message[record["messageId"]] = keys
+            queued_jobs.append((record["messageId"], workflow_job))
+        else:
+            other_jobs.append(
+                (record["messageId"], workflow_job, get_delivery_id(record))
+            )
+
+    if queued_jobs:
+        launched = {}
+        try:
+            launched, _ = launch_instances_for_jobs(queued_jobs)
+        except Exception:
+            logger.exception(f"Failed to launch instances for {len(queued_jobs)} jobs")
+        for message_id, workflow_job in queued_jobs:
+            keys = keys_by_message[message_id]
+            instance_id = launched.get(workflow_job["workflow_job"]["id"])
+            if instance_id:
+                complete_event(
+                    keys,
+                    {
+                        "statusCode": 201,
+                        "body": json.dumps({"instance_id": instance_id}),
+                    },
+                )
+            else:
+                release_event(keys)
+                failures.append(message_id)
+    for message_id, workflow_job, delivery_id in other_jobs:
+        try:
+            response = process_once(workflow_job, delivery_id, context)
+            logger.debug(f"Processed message {message_id}: {response}")
+        except Exception:
+            logger.exception(f"Failed to process message {message_id}")
+            failures.append(message_id)
+    # A batch mixes actions, so its metrics aren't reported against any one of them.
+    metrics = get_metrics()
+    metrics.set_dimension("Action", "batch")
+    if failures:
+        metrics.increment("Errors", len(failures))
+    return {
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]
+    }
+
+
+@instrumented
+def manage_runners(event, context):
+    """
+    The handler for the webhook endpoint, when events are processed synchronously.
+    """
+    error_response = check_signature(event)
+    if error_response:
+        return error_response
     workflow_job = json.loads(event["body"])
+    return process_once(workflow_job, event["headers"].get(DELIVERY_HEADER), context)
+
+
+def remove_job_runner(job, deadline):
+    """
+    Removes the runner that ran the completed job and terminates its instance.
+
+    The instance is found from the `runner_name` in the job, with a single tag lookup, so no other
+    runner is touched. In particular, an idle runner that was launched for a job that's still
+    queued is left to pick that job up. If the job was cancelled before a runner picked it up, it
+    has no runner name, and the instance that was launched for it is removed instead, but only if
+    its runner is idle.
+    """
+    client = get_ec2_client()
+    runner_name = job.get("runner_name")
+    if runner_name:
+        instance = find_runner_instance(client, RUNNER_NAME_TAG_KEY, runner_name)
+        runner_id = job.get("runner_id")
+    else:
+        instance = find_runner_instance(client, JOB_ID_TAG_KEY, str(job["id"]))
+        runner_id = None
+        if instance:
+            runner = list_runners().by_name.get(
+                get_instance_tag(instance, RUNNER_NAME_TAG_KEY)
+            )
+            if runner and not runner.busy:
+                runner_id = runner.id
+    if instance:
+        record_job_instance_type(job, instance)
+    if not instance or not runner_id:
+        logger.debug(f"No idle runner instance to remove for job {job['id']}")
+        return {
+            "statusCode": 200,
+            "body": "No idle runner instance to remove for the job",
+        }
+
+    results = remove_runners([runner_id], deadline)
+    # The instance is only terminated if its runner was removed. If the removal failed, the runner
+    # may have picked up another job in the meantime.
+    instance_ids = [instance["InstanceId"]] if results["removed"] else []
+    if instance_ids:
+        logger.debug(f"Will terminate instances with IDs {instance_ids}")
+        client.terminate_instances(InstanceIds=instance_ids)
+    if results["deferred"]:
+        # Tagging the instance hands it over to the sweeper, which removes it once it can.
+        client.create_tags(
+            Resources=[instance["InstanceId"]],
+            Tags=[{"Key": IDLE_SINCE_TAG_KEY, "Value": str(int(time.time()))}],
+        )
+        logger.debug(
+            f"Ran out of time; deferred removal of runners {results['deferred']}"
+        )
+    return {
+        "statusCode": 202 if results["deferred"] else 201,
+        "TerminatedInstanceIds": instance_ids,
+        "RemovedRunnerIds": results["removed"],
+        "FailedRunnerIds": results["failed"],
+        "DeferredRunnerIds": results["deferred"],
+    }
+
+
+def get_job_span_attributes(workflow_job):
+    job = workflow_job["workflow_job"]
+    return {
+        "job.id": job["id"],
+        "job.run_id": job["run_id"],
+        "job.labels": ",".join(job["labels"]),
+    }
+
+
+def process_workflow_job(workflow_job, context):
     action = workflow_job["action"]
     logger.debug(f"Received workflow_job with {action} action")
+    get_metrics().set_dimension("Action", action)
+    if "self-hosted" in workflow_job["workflow_job"]["labels"]:
+        record_job_timing(workflow_job)
     if action == "in_progress":
         logger.debug(
             "A workflow_job with an `in_progress` action will not be processed"
@@ -250,30 +3977,32 @@ def manage_runners(event, context):
         }
 
     response = {}
-    client = boto3.client("ec2")
+    runner_mode = get_runner_mode()
     if action == "queued":
-        (
-            ami_id,
-            iam_instance_profile,
-            instance_type,
-            key_name,
-            security_group_id,
-            subnet_id,
-        ) = validate_env_vars()
-        registration_token = get_registration_token()
-        user_data_script_with_token = get_user_data_script(registration_token)
-        response = client.run_instances(
-            IamInstanceProfile={"Arn": iam_instance_profile},
-            ImageId=ami_id,
-            InstanceType=instance_type,
-            KeyName=key_name,
-            MaxCount=1,
-            MinCount=1,
-            SecurityGroupIds=[security_group_id],
-            SubnetId=subnet_id,
-            UserData=user_data_script_with_token,
-        )
-        instance_id = response["Instances"][0]["InstanceId"]
+        with start_span(
+            "workflow_job.queued", get_job_span_attributes(workflow_job)
+        ) as span:
+            with start_span("claim_idle_runners"):
+                reused_instance_ids = claim_idle_runners(
+                    1, workflow_job["workflow_job"]["labels"]
+                )
+            if reused_instance_ids:
+                logger.debug(f"Reusing the idle runner on {reused_instance_ids[0]}")
+                span.set_attribute("instance.id", reused_instance_ids[0])
+                span.set_attribute("runner.reused", True)
+                record_scale_up()
+                return {
+                    "statusCode": 200,
+                    "body": json.dumps(
+                        {"instance_id": reused_instance_ids[0], "reused": True}
+                    ),
+                }
+            with start_span("launch_instance"):
+                if runner_mode == "jit":
+                    instance_id = launch_jit_instance(workflow_job)
+                else:
+                    instance_id = launch_persistent_instance(workflow_job)
+            span.set_attribute("instance.id", instance_id)
         logger.debug(f"Launched EC2 instance with ID {instance_id}")
         response = {
             "statusCode": 201,
@@ -283,20 +4012,70 @@ def manage_runners(event, context):
                 }
             ),
         }
+    elif action == "completed" and runner_mode == "jit":
+        response = release_jit_runner(workflow_job["workflow_job"])
+    elif action == "completed" and get_scale_down_policy().idle_ttl_seconds > 0:
+        response = retain_job_runner(workflow_job["workflow_job"])
+    elif action == "completed" and not github_rate_limit.allows_cleanup():
+        logger.debug(
+            "The Github rate limit is running low; leaving the runner for the sweeper"
+        )
+        response = retain_job_runner(workflow_job["workflow_job"])
     elif action == "completed":
-        idle_runners = get_idle_runners()
-        ec2_response = client.describe_instances()
-        instance_ids = []
-        for (runner_id, private_ip) in idle_runners:
-            for reservation in ec2_response["Reservations"]:
-                for instance in reservation["Instances"]:
-                    if instance["PrivateDnsName"].startswith(private_ip):
-                        instance_id = instance["InstanceId"]
-                        instance_ids.append(instance_id)
-        for (runner_id, private_ip) in idle_runners:
-            logger.debug(f"Will remove idle runner {private_ip}")
-            remove_runner(runner_id)
-        logger.debug(f"Will terminate instances with IDs {instance_ids}")
-        client.terminate_instances(InstanceIds=instance_ids)
-        response = {"statusCode": 201, "TerminatedInstanceIds": instance_ids}
+        response = remove_job_runner(workflow_job["workflow_job"], Deadline(context))
+    if action == "completed":
+        emit_job_timing_metrics(workflow_job["workflow_job"]["id"])
     return response
+
+
+def main(argv=None):
+    """
+    The command line interface for reports. The store is selected by the same variables as the
+    handlers use, e.g:
+
+    JOB_TIMINGS_BACKEND=dynamodb JOB_TIMINGS_TABLE_NAME=gha-runner-job-timings \\
+      python -m manage_runners.app job-timings --hours 24
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="manage_runners.app")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    job_timings = subcommands.add_parser(
+        "job-timings",
+        help="Report the queue wait and run duration percentiles of recent jobs",
+    )
+    job_timings.add_argument(
+        "--hours",
+        type=float,
+        default=24,
+        help="Report on the jobs queued in this many hours (default: 24)",
+    )
+    job_timings.add_argument(
+        "--json", action="store_true", help="Print the report as JSON"
+    )
+    args = parser.parse_args(argv)
+
+    timings = get_job_timing_store().list(since=time.time() - args.hours * 60 * 60)
+    rows = summarize_job_timings(timings)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print(format_job_timing_report(rows))
+    return 0
+
+
+# The launch profiles are validated during the init phase of a function that launches instances, so
+# a configuration error fails the first cold start, rather than every queued job.
+if os.getenv("AMI_ID"):
+    get_launch_profiles()
+# The prefetch happens when the module is loaded, during the init phase of the Lambda, so the first
+# `queued` event handled by a new execution environment doesn't have to wait for the token. JIT
+# runners don't use registration tokens, so there's nothing to prefetch in that mode.
+if (
+    os.getenv("PREFETCH_REGISTRATION_TOKEN") == "true"
+    and os.getenv("RUNNER_MODE", "persistent") == "persistent"
+):
+    registration_token_cache.prefetch()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import json
+import os
+import pytest
+import subprocess
+import sys
+
+
+# These are deliberately generous, so the tests don't fail on a slow machine, but a regression
+# like importing boto3 at the top level of the module will exceed them. They can be overridden to
+# match the environment the benchmark is running in.
+IMPORT_BUDGET_MS = float(os.getenv("COLD_START_IMPORT_BUDGET_MS", "150"))
+FIRST_INVOCATION_BUDGET_MS = float(os.getenv("COLD_START_INVOCATION_BUDGET_MS", "250"))
+HEAVY_MODULES = ["boto3", "botocore", "cryptography", "jwt", "requests"]
+
+# Each measurement is taken in a new interpreter, so that it's a genuine cold start. The Github
+# and EC2 calls are replaced with stubs, so what's measured is the cost of loading the code and
+# handling the event, not the network.
+BENCHMARK_SCRIPT = """
+import hashlib
+import hmac
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from manage_runners import app
+import_ms = (time.perf_counter() - start) * 1000
+loaded_after_import = [m for m in HEAVY_MODULES if m in sys.modules]
+
+from unittest import mock
+
+action = sys.argv[1]
+labels = ["ubuntu-latest"] if action == "not_self_hosted" else ["self-hosted"]
+body = json.dumps(
+    {
+        "action": "queued" if action == "not_self_hosted" else action,
+        "workflow_job": {
+            "id": 2832853555,
+            "run_id": 940463255,
+            "labels": labels,
+            "runner_id": 3155,
+            "runner_name": "gha-runner-i-123456",
+        },
+    }
+)
+digest = hmac.new(b"secret", body.encode(), hashlib.sha256).hexdigest()
+event = {"headers": {"X-Hub-Signature-256": "sha256=" + digest}, "body": body}
+
+ec2_client = mock.Mock()
+ec2_client.run_instances.return_value = {"Instances": [{"InstanceId": "i-123456"}]}
+ec2_client.describe_instances.return_value = {
+    "Reservations": [{"Instances": [{"InstanceId": "i-123456"}]}]
+}
+with mock.patch.object(app, "get_ec2_client", return_value=ec2_client), mock.patch.object(
+    app, "get_registration_token", return_value="token"
+), mock.patch.object(app, "remove_runner", return_value=204):
+    start = time.perf_counter()
+    app.manage_runners(event, None)
+    invocation_ms = (time.perf_counter() - start) * 1000
+
+print(
+    json.dumps(
+        {
+            "import_ms": import_ms,
+            "invocation_ms": invocation_ms,
+            "loaded_after_import": loaded_after_import,
+            "loaded_after_invocation": [m for m in HEAVY_MODULES if m in sys.modules],
+        }
+    )
+)
+"""
+
+
+def run_cold_start(action):
+    env = dict(
+        os.environ,
+        GITHUB_APP_SECRET="secret",
+        AMI_ID="ami-092fe15da02f3f1bg",
+        EC2_IAM_INSTANCE_PROFILE="arn:aws:iam::389640522532:instance-profile/upload_build_artifacts",
+        EC2_INSTANCE_TYPE="t2.medium",
+        EC2_KEY_NAME="gha_runner_image_builder",
+        EC2_SECURITY_GROUP_ID="sg-0f802f984aa514480",
+        EC2_VPC_SUBNET_ID="subnet-08486e3b32f903438",
+    )
+    env.pop("PREFETCH_REGISTRATION_TOKEN", None)
+    script = f"HEAVY_MODULES = {HEAVY_MODULES!r}\n{BENCHMARK_SCRIPT}"
+    result = subprocess.run(
+        [sys.executable, "-c", script, action],
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=os.path.join(os.path.dirname(__file__), "..", ".."),
+        check=True,
+    )
+    measurement = json.loads(result.stdout.strip().splitlines()[-1])
+    print(
+        f"{action}: import {measurement['import_ms']:.1f}ms, "
+        f"first invocation {measurement['invocation_ms']:.1f}ms"
+    )
+    return measurement
+
+
+@pytest.mark.parametrize(
+    "action", ["queued", "in_progress", "completed", "not_self_hosted"]
+)
+def test_cold_start(action):
+    measurement = run_cold_start(action)
+
+    assert measurement["loaded_after_import"] == []
+    assert measurement["import_ms"] < IMPORT_BUDGET_MS
+    assert measurement["invocation_ms"] < FIRST_INVOCATION_BUDGET_MS
+
+
+@pytest.mark.parametrize("action", ["in_progress", "not_self_hosted"])
+def test_events_that_are_ignored_do_not_load_heavy_modules(action):
+    measurement = run_cold_start(action)
+
+    assert measurement["loaded_after_invocation"] == []
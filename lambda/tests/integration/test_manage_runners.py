@@ -1,8 +1,12 @@
 import datetime
 import hmac
 import hashlib
+import json
 import os
 import pytest
+import shutil
+import subprocess
+import uuid
 
 from dateutil.tz import tzutc
 from manage_runners import app
@@ -617,3 +621,76 @@ def test_manage_runners_with_completed_job_integration(
     )
     response = app.manage_runners(apigw_event, "")
     print(response)
+
+
+@pytest.mark.skipif(
+    not os.getenv("SCCACHE_TEST_ENDPOINT") or not shutil.which("sccache"),
+    reason="needs sccache and an S3-compatible endpoint",
+)
+def test_sccache_reuses_compilation_from_s3_compatible_store(tmp_path):
+    """
+    Builds a crate twice, from clean target directories, with sccache backed by an S3-compatible
+    store, as it's configured on the runners, and checks the second build comes from the cache.
+
+    It can be run against a local MinIO container with `make test-sccache`, or against another
+    store by setting `SCCACHE_TEST_ENDPOINT` and the keys of a user who can create a bucket:
+
+    export AWS_ACCESS_KEY_ID=<access key id>
+    export AWS_SECRET_ACCESS_KEY=<secret access key>
+    export SCCACHE_TEST_ENDPOINT=http://localhost:9000
+
+    pytest tests/integration -k sccache
+    """
+    import boto3
+
+    endpoint = os.getenv("SCCACHE_TEST_ENDPOINT")
+    bucket = os.getenv("SCCACHE_TEST_BUCKET", "gha-runner-sccache-test")
+    s3 = boto3.client("s3", endpoint_url=endpoint, region_name="us-east-1")
+    if bucket not in [b["Name"] for b in s3.list_buckets()["Buckets"]]:
+        s3.create_bucket(Bucket=bucket)
+    crate = tmp_path / "crate"
+    (crate / "src").mkdir(parents=True)
+    (crate / "Cargo.toml").write_text(
+        '[package]\nname = "cached"\nversion = "0.1.0"\nedition = "2021"\n'
+    )
+    (crate / "src" / "lib.rs").write_text(
+        "pub fn add(a: u64, b: u64) -> u64 {\n    a + b\n}\n"
+    )
+    env = dict(
+        os.environ,
+        RUSTC_WRAPPER=shutil.which("sccache"),
+        CARGO_INCREMENTAL="0",
+        SCCACHE_BUCKET=bucket,
+        SCCACHE_REGION="us-east-1",
+        SCCACHE_ENDPOINT=endpoint,
+        SCCACHE_S3_USE_SSL=str(endpoint.startswith("https://")).lower(),
+        # Each run has its own prefix, so the first build can't be served from an earlier run.
+        SCCACHE_S3_KEY_PREFIX=f"test/{uuid.uuid4()}",
+        SCCACHE_SERVER_PORT="4227",
+    )
+
+    def sccache(*args):
+        return subprocess.run(
+            ["sccache", *args], env=env, capture_output=True, text=True, check=True
+        ).stdout
+
+    def build(target_dir):
+        subprocess.run(
+            ["cargo", "build", "--target-dir", str(target_dir)],
+            cwd=crate,
+            env=env,
+            check=True,
+        )
+
+    subprocess.run(["sccache", "--stop-server"], env=env, capture_output=True)
+    sccache("--start-server")
+    try:
+        build(tmp_path / "first")
+        sccache("--zero-stats")
+        build(tmp_path / "second")
+        stats = json.loads(sccache("--show-stats", "--stats-format", "json"))["stats"]
+    finally:
+        subprocess.run(["sccache", "--stop-server"], env=env, capture_output=True)
+
+    assert sum(stats["cache_hits"]["counts"].values()) >= 1
+    assert sum(stats["cache_misses"]["counts"].values()) == 0
@@ -18,8 +18,9 @@ module "vpc" {
   name = var.subnet_name
   cidr = "10.0.0.0/16"
   azs = var.availability_zones
-  public_subnets = ["10.0.0.0/24"]
-  private_subnets = ["10.0.1.0/24"]
+  # One subnet in each availability zone, so runners can be launched in whichever has capacity.
+  public_subnets = ["10.0.0.0/24", "10.0.2.0/24", "10.0.4.0/24"]
+  private_subnets = ["10.0.1.0/24", "10.0.3.0/24", "10.0.5.0/24"]
   enable_nat_gateway = true
   single_nat_gateway = true
   enable_dns_hostnames = false
@@ -139,3 +140,76 @@ resource "aws_secretsmanager_secret_version" "github_app_secret" {
   secret_id = aws_secretsmanager_secret.github_app_secret.id
   secret_string = var.secret_github_app_secret
 }
+
+data "aws_region" "current" {}
+
+# The shared compilation cache for the runners. The objects are keyed by toolchain, and ones that
+# haven't been written for a while are expired, so the bucket doesn't keep growing as toolchains
+# change.
+resource "aws_s3_bucket" "sccache" {
+  bucket = var.sccache_bucket_name
+}
+
+resource "aws_s3_bucket_public_access_block" "sccache" {
+  bucket = aws_s3_bucket.sccache.id
+  block_public_acls = true
+  block_public_policy = true
+  ignore_public_acls = true
+  restrict_public_buckets = true
+}
+
+# sccache never rewrites an object it gets a hit on, so an object's age is the time since it was
+# first compiled, not since it was last used, and the expiry removes hot entries along with stale
+# ones. It's long enough that this only costs a rebuild now and then. Entries for a toolchain that's
+# no longer in the image are under their own prefix, and can be removed with it.
+resource "aws_s3_bucket_lifecycle_configuration" "sccache" {
+  bucket = aws_s3_bucket.sccache.id
+  rule {
+    id = "expire-stale-cache-entries"
+    status = "Enabled"
+    filter {}
+    expiration {
+      days = var.sccache_expiration_days
+    }
+  }
+}
+
+# The cache traffic goes through a gateway endpoint rather than the NAT gateway.
+resource "aws_vpc_endpoint" "s3" {
+  vpc_id = module.vpc.vpc_id
+  service_name = "com.amazonaws.${data.aws_region.current.name}.s3"
+  route_table_ids = concat(module.vpc.public_route_table_ids, module.vpc.private_route_table_ids)
+}
+
+resource "aws_iam_policy" "gha_runner_sccache" {
+  name = "gha_runner_sccache"
+  description = "Allows runner instances to use the shared compilation cache and report its hit rate."
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = ["s3:GetObject", "s3:PutObject"]
+        Resource = "${aws_s3_bucket.sccache.arn}/*"
+      },
+      {
+        Effect = "Allow"
+        Action = ["s3:ListBucket"]
+        Resource = aws_s3_bucket.sccache.arn
+      },
+      {
+        Effect = "Allow"
+        Action = ["cloudwatch:PutMetricData"]
+        Resource = "*"
+        Condition = {
+          StringEquals = { "cloudwatch:namespace" = "GhaRunners" }
+        }
+      }
+    ]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "gha_runner_sccache" {
+  role = var.gha_runner_instance_role_name
+  policy_arn = aws_iam_policy.gha_runner_sccache.arn
+}
@@ -13,3 +13,7 @@ output "gha_runner_image_builder_security_group_name" {
 output "manage_runners_repository_url" {
   value = aws_ecr_repository.manage_runners.repository_url
 }
+
+output "sccache_bucket_name" {
+  value = aws_s3_bucket.sccache.id
+}
@@ -3,6 +3,14 @@
 TERRAFORM_VERSION="1.3.5"
 TERRAFORM_ARCHIVE_NAME="terraform_${TERRAFORM_VERSION}_linux_amd64.zip"
 TERRAFORM_URL="https://releases.hashicorp.com/terraform/${TERRAFORM_VERSION}/${TERRAFORM_ARCHIVE_NAME}"
+# The runner version and checksum are supplied by the Packer build.
+RUNNER_VERSION="${RUNNER_VERSION:?The RUNNER_VERSION variable must be set}"
+RUNNER_SHA256="${RUNNER_SHA256:?The RUNNER_SHA256 variable must be set}"
+RUNNER_ARCHIVE_NAME="actions-runner-linux-x64-${RUNNER_VERSION}.tar.gz"
+RUNNER_URL="https://github.com/actions/runner/releases/download/v${RUNNER_VERSION}/${RUNNER_ARCHIVE_NAME}"
+SCCACHE_VERSION="${SCCACHE_VERSION:?The SCCACHE_VERSION variable must be set}"
+SCCACHE_NAME="sccache-v${SCCACHE_VERSION}-x86_64-unknown-linux-musl"
+SCCACHE_URL="https://github.com/mozilla/sccache/releases/download/v${SCCACHE_VERSION}/${SCCACHE_NAME}.tar.gz"
 
 sudo DEBIAN_FRONTEND=noninteractive apt update
 retry_count=1
@@ -12,7 +20,7 @@ while [[ $retry_count -le 20 ]]; do
   # All these packages are necessary for a full build of all safe_network code,
   # including test binaries.
   sudo DEBIAN_FRONTEND=noninteractive apt install -y \
-    build-essential docker.io git jq libssl-dev musl-tools pkg-config ripgrep unzip
+    build-essential docker.io git jq libssl-dev mdadm musl-tools pkg-config ripgrep unzip
   exit_code=$?
   if [[ $exit_code -eq 0 ]]; then
       echo "packages installed successfully"
@@ -51,3 +59,28 @@ sudo ./aws/install
 curl -O $TERRAFORM_URL
 unzip $TERRAFORM_ARCHIVE_NAME
 sudo mv terraform /usr/local/bin
+
+# The runner is unpacked into the image, so instances only have to configure and start it. Its
+# version is recorded alongside it, so the user data can tell if it's stale.
+curl -L -O $RUNNER_URL
+if ! echo "${RUNNER_SHA256}  ${RUNNER_ARCHIVE_NAME}" | sha256sum -c; then
+  echo "The checksum of ${RUNNER_ARCHIVE_NAME} doesn't match ${RUNNER_SHA256}"
+  exit 1
+fi
+sudo mkdir /opt/actions-runner
+sudo tar xzf $RUNNER_ARCHIVE_NAME -C /opt/actions-runner
+sudo /opt/actions-runner/bin/installdependencies.sh
+echo "$RUNNER_VERSION" | sudo tee /opt/actions-runner/.runner-version
+sudo chown -R ubuntu:ubuntu /opt/actions-runner
+rm $RUNNER_ARCHIVE_NAME
+
+# sccache is configured by the user data, if the instance is launched with a cache bucket.
+curl -L -O $SCCACHE_URL
+curl -L -O "${SCCACHE_URL}.sha256"
+if ! echo "$(cut -d ' ' -f 1 ${SCCACHE_NAME}.tar.gz.sha256)  ${SCCACHE_NAME}.tar.gz" | sha256sum -c; then
+  echo "The checksum of ${SCCACHE_NAME}.tar.gz doesn't match"
+  exit 1
+fi
+tar xzf ${SCCACHE_NAME}.tar.gz
+sudo install -m 0755 ${SCCACHE_NAME}/sccache /usr/local/bin/sccache
+rm -rf ${SCCACHE_NAME} ${SCCACHE_NAME}.tar.gz ${SCCACHE_NAME}.tar.gz.sha256
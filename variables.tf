@@ -42,3 +42,18 @@ variable "secret_github_app_secret" {
   default = ""
   description = "The secret defined on the Github self hosted runner app. Provide value from encrypted tfvars file."
 }
+
+variable "gha_runner_instance_role_name" {
+  default = "upload_build_artifacts"
+  description = "The name of the role in the instance profile that GHA runner instances are launched with"
+}
+
+variable "sccache_bucket_name" {
+  default = "maidsafe-gha-runner-sccache"
+  description = "The name of the S3 bucket for the runners' shared compilation cache"
+}
+
+variable "sccache_expiration_days" {
+  default = 90
+  description = "The number of days after which an object in the compilation cache expires. Objects aren't rewritten when sccache gets a hit on them, so this counts from when the object was first written, and entries still in use expire too."
+}